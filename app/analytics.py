@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+import numpy as np
+import time
+import os
+import cache
+
+# Season and career rollups of the Final games statistics. Statistics of all the players
+# are loaded with one query per table into NumPy columns and aggregated per personId at once.
+
+# Statistics columns summed per player
+SKATER_COLUMNS = ['goals', 'assists', 'shots', 'hits', 'plusMinus', 'penaltyMinutes', 'powerPlayGoals',
+                  'shortHandedGoals', 'blocked', 'takeaways', 'giveaways', 'timeOnIceSec']
+GOALIE_COLUMNS = ['shots', 'saves', 'powerPlaySaves', 'shortHandedSaves', 'evenSaves', 'timeOnIceSec']
+
+# Names are looked up in chunks of that many ids
+NAMES_CHUNK = 500
+
+# Rollups are computed once per season (or for all the seasons) and kept until the next update
+rollup_cache = cache.TTLCache(ttl = int(os.environ.get('ANALYTICS_CACHE_TTL', 3600)))
+
+# Drop cached rollups (called when the database is updated)
+def invalidate():
+    rollup_cache.invalidate()
+
+# Returns personIds and statistics (one row per player and game) of the Final games,
+# of one season or of all the seasons, as NumPy arrays
+def db_load_stats(conn, table, columns, season=None):
+    cur = conn.cursor()
+
+    season_filter = 'AND g.season = ?' if season is not None else ''
+    params = (season,) if season is not None else ()
+    cur.execute(f"""
+        SELECT s.personId, {', '.join('s.' + column for column in columns)}
+        FROM {table} s INNER JOIN games g ON s.gamePk = g.gamePk
+        WHERE g.gameType = 'P' {season_filter}""",
+        params
+    )
+    rows = cur.fetchall()
+
+    if not rows:
+        return (np.empty(0, dtype=np.int64), np.empty((0, len(columns)), dtype=np.int64))
+
+    data = np.array(rows, dtype=np.int64)
+
+    return (data[:, 0], data[:, 1:])
+
+# Returns {personId: fullName} of the players
+def db_get_names(conn, person_ids):
+    cur = conn.cursor()
+    result = {}
+
+    ids = [int(personId) for personId in person_ids]
+    for idx in range(0, len(ids), NAMES_CHUNK):
+        chunk = ids[idx:idx + NAMES_CHUNK]
+        cur.execute(f"""
+            SELECT personId, fullName
+            FROM persons
+            WHERE personId IN ({', '.join('?' * len(chunk))})""",
+            tuple(chunk)
+        )
+        for (personId, fullName) in cur:
+            result[personId] = fullName
+
+    return result
+
+# Sums of the statistics rows per player: (personIds, games played, totals matrix)
+def totals_by_person(person_ids, values):
+    if len(person_ids) == 0:
+        return (person_ids, np.empty(0, dtype=np.int64), values)
+
+    order = np.argsort(person_ids, kind='stable')
+    ids = person_ids[order]
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+
+    totals = np.add.reduceat(values[order], starts, axis=0)
+    games = np.diff(np.r_[starts, len(ids)])
+
+    return (ids[starts], games, totals)
+
+# Competition ranking (1 is the biggest value, equal values share the rank)
+def rank_desc(values):
+    ordered = np.sort(values)[::-1]
+
+    return np.searchsorted(-ordered, -values, side='left') + 1
+
+# values / divisor, 0 where the divisor is 0
+def ratio(values, divisor, scale=1):
+    values = np.asarray(values, dtype=np.float64) * scale
+    divisor = np.asarray(divisor, dtype=np.float64)
+
+    return np.divide(values, divisor, out=np.zeros_like(values), where=divisor != 0)
+
+# Per-player totals, per-game rates and rankings as columns: {name: array}
+def skater_rollup(person_ids, values):
+    (persons, games, totals) = totals_by_person(person_ids, values)
+
+    result = {'personId': persons, 'games': games}
+    for (idx, column) in enumerate(SKATER_COLUMNS):
+        result[column] = totals[:, idx]
+
+    result['points'] = result['goals'] + result['assists']
+    result['pointsPerGame'] = ratio(result['points'], games)
+    result['goalsPerGame'] = ratio(result['goals'], games)
+    result['shootingPct'] = ratio(result['goals'], result['shots'], 100)
+    result['timeOnIcePerGameSec'] = ratio(result['timeOnIceSec'], games)
+    result['pointsPer60'] = ratio(result['points'], result['timeOnIceSec'], 3600)
+
+    result['pointsRank'] = rank_desc(result['points'])
+    result['goalsRank'] = rank_desc(result['goals'])
+    result['plusMinusRank'] = rank_desc(result['plusMinus'])
+
+    return result
+
+def goalie_rollup(person_ids, values):
+    (persons, games, totals) = totals_by_person(person_ids, values)
+
+    result = {'personId': persons, 'games': games}
+    for (idx, column) in enumerate(GOALIE_COLUMNS):
+        result[column] = totals[:, idx]
+
+    # Save percentage of all the shots, not the average of the per-game ones
+    result['goalsAgainst'] = result['shots'] - result['saves']
+    result['savePct'] = ratio(result['saves'], result['shots'], 100)
+    result['goalsAgainstAverage'] = ratio(result['goalsAgainst'], result['timeOnIceSec'], 3600)
+    result['savesPerGame'] = ratio(result['saves'], games)
+
+    result['savePctRank'] = rank_desc(result['savePct'])
+    result['savesRank'] = rank_desc(result['saves'])
+
+    return result
+
+# Rollup columns as a list of dicts (JSON friendly), ordered by the rank column
+def to_records(columns, names, rank):
+    order = np.argsort(columns[rank], kind='stable')
+    records = []
+
+    for idx in order:
+        record = {'personId': int(columns['personId'][idx]),
+                  'fullName': names.get(int(columns['personId'][idx]))}
+        for (name, values) in columns.items():
+            if name == 'personId':
+                continue
+            value = values[idx]
+            record[name] = round(float(value), 3) if values.dtype.kind == 'f' else int(value)
+        records.append(record)
+
+    return records
+
+# Rollup of a season (None - all the seasons):
+# {'season': season, 'skaters': [...], 'goalies': [...], 'seconds': computation time}.
+# connection() returns a context manager with a database connection; it is used on cache misses only.
+def get_rollup(connection, season=None):
+    key = season if season is not None else 'all'
+    rollup = rollup_cache.get(key)
+    if rollup is not None:
+        return rollup
+
+    start = time.perf_counter()
+    with connection() as conn:
+        skaters = skater_rollup(*db_load_stats(conn, 'skaterStats', SKATER_COLUMNS, season))
+        goalies = goalie_rollup(*db_load_stats(conn, 'goalieStats', GOALIE_COLUMNS, season))
+        names = db_get_names(conn, np.r_[skaters['personId'], goalies['personId']])
+
+    rollup = {
+        'season': season,
+        'skaters': to_records(skaters, names, 'pointsRank'),
+        'goalies': to_records(goalies, names, 'savePctRank'),
+        'seconds': round(time.perf_counter() - start, 4)
+    }
+
+    return rollup_cache.put(key, rollup)
@@ -1,39 +1,287 @@
-from flask import Flask, request, render_template
+from flask import Flask, request, render_template, make_response, jsonify, g, has_request_context
 from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_flask_exporter.multiprocess import GunicornInternalPrometheusMetrics
+from prometheus_client import Counter, Gauge, Histogram
 from markupsafe import escape
 from cpu_load_generator import load_all_cores
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+import collections
+import decimal
+import threading
+import hashlib
+import gzip
+import json
+import time
+import os
 import mariadb
 import nhltop
+import dbpool
+import dbstats
+import analytics
+import cache
+import jobs
+
+# orjson is several times faster than json on the API payloads; json is used if it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
-metrics = PrometheusMetrics(app)
 
-# prevent cached responses
+# Several worker processes (gunicorn) keep their metrics in PROMETHEUS_MULTIPROC_DIR, merged on /metrics
+if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    metrics = GunicornInternalPrometheusMetrics(app)
+else:
+    metrics = PrometheusMetrics(app)
+
+# Database connection pool shared by all the request threads (statements of its connections are timed)
+db_pool = dbpool.ConnectionPool(
+    lambda: dbstats.InstrumentedConnection(nhltop.db_connect()),
+    min_size = int(os.environ.get('DB_POOL_MIN', 1)),
+    max_size = int(os.environ.get('DB_POOL_MAX', 10)),
+    timeout = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+)
+
+DB_POOL_WAIT = Histogram('nhltop_db_pool_wait_seconds', 'Time spent waiting for a database connection')
+DB_POOL_IN_USE = Gauge('nhltop_db_pool_in_use', 'Database connections checked out of the pool',
+                       multiprocess_mode='livesum')
+DB_POOL_SIZE = Gauge('nhltop_db_pool_size', 'Open database connections of the pool', multiprocess_mode='livesum')
+
+# Requests, which run more statements than that, are reported (N+1 query patterns)
+DB_QUERY_BUDGET = int(os.environ.get('DB_QUERY_BUDGET', 10))
+
+DB_QUERY_SECONDS = Histogram('nhltop_db_query_seconds', 'Database statement latency', ['query'])
+DB_QUERY_ROWS = Counter('nhltop_db_query_rows', 'Rows returned or affected by database statements', ['query'])
+DB_REQUEST_QUERIES = Histogram('nhltop_db_request_queries', 'Database statements per request', ['endpoint'],
+                               buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+DB_QUERY_BUDGET_EXCEEDED = Counter('nhltop_db_query_budget_exceeded', 'Requests over the query budget',
+                                   ['endpoint'])
+
+def observe_query(template, seconds, rows):
+    DB_QUERY_SECONDS.labels(template).observe(seconds)
+    if rows >= 0:
+        DB_QUERY_ROWS.labels(template).inc(rows)
+    if has_request_context() and 'queries' in g:
+        g.queries.append(template)
+
+dbstats.add_query_observer(observe_query)
+
+# Database connection from the pool (pool metrics are updated on checkout and return)
+@contextmanager
+def db_connection():
+    start = time.monotonic()
+    with db_pool.connection() as db_conn:
+        DB_POOL_WAIT.observe(time.monotonic() - start)
+        DB_POOL_IN_USE.inc()
+        DB_POOL_SIZE.set(db_pool.size)
+        try:
+            yield db_conn
+        finally:
+            DB_POOL_IN_USE.dec()
+    DB_POOL_SIZE.set(db_pool.size)
+
+# Longest leaderboard served by /leaders/
+LEADERS_MAX_LIMIT = int(os.environ.get('LEADERS_MAX_LIMIT', 100))
+
+# Rendered main page (dropped after MAIN_CACHE_TTL seconds or when the database is updated)
+page_cache = cache.TTLCache(ttl = int(os.environ.get('MAIN_CACHE_TTL', 300)))
+
+# Statistics of players in games, keyed by (gamePk, personId)
+stats_cache = cache.LRUCache(maxsize = int(os.environ.get('STATS_CACHE_SIZE', 2048)))
+
+STATS_CACHE_HITS = Counter('nhltop_stats_cache_hits', 'Player statistics served from the cache')
+STATS_CACHE_MISSES = Counter('nhltop_stats_cache_misses', 'Player statistics fetched from the database')
+STATS_CACHE_SIZE = Gauge('nhltop_stats_cache_size', 'Entries of the player statistics cache',
+                         multiprocess_mode='livesum')
+
+# Update pipeline metrics, fed by the stage observer of nhltop
+UPDATE_STAGE_SECONDS = Histogram('nhltop_update_stage_seconds', 'Time spent in the update stages', ['stage'])
+API_REQUEST_SECONDS = Histogram('nhltop_api_request_seconds', 'NHL API request latency', ['endpoint'])
+API_RETRIES = Counter('nhltop_api_retries', 'NHL API requests retried', ['reason'])
+DB_ROWS_WRITTEN = Counter('nhltop_db_rows_written', 'Rows written by updates', ['table'])
+DB_COMMIT_SECONDS = Histogram('nhltop_db_commit_seconds', 'Commit latency of the update transactions')
+
+def observe_stage(kind, name, label, value):
+    if name == 'api_request':
+        API_REQUEST_SECONDS.labels(label).observe(value)
+    elif name == 'db_commit':
+        DB_COMMIT_SECONDS.observe(value)
+    elif name == 'api_retries':
+        API_RETRIES.labels(label).inc(value)
+    elif name == 'rows':
+        DB_ROWS_WRITTEN.labels(label).inc(value)
+    elif kind == 'span':
+        UPDATE_STAGE_SECONDS.labels(name).observe(value)
+
+nhltop.add_stage_observer(observe_stage)
+
+# Every worker process has its own caches, while the data is updated by a job of one of them (or by
+# the CLI). Caches of all the workers are dropped when the data version (nhltop.db_get_data_version)
+# changes; it is checked at most every DATA_VERSION_INTERVAL seconds, so old data is served no longer than that.
+DATA_VERSION_INTERVAL = float(os.environ.get('DATA_VERSION_INTERVAL', 5))
+
+# Routes served from the caches
+CACHED_ENDPOINTS = {'rt_main', 'rt_stats', 'rt_analytics', 'rt_api_seasons', 'rt_api_top', 'rt_api_stats'}
+
+data_version = {'value': None, 'checked': 0}
+data_version_lock = threading.Lock()
+
+def invalidate_caches():
+    page_cache.invalidate()
+    stats_cache.invalidate()
+    analytics.invalidate()
+    STATS_CACHE_SIZE.set(0)
+
+# Registered before start_query_count, so the check isn't counted against the query budget of the request
+@app.before_request
+def check_data_version():
+    if request.endpoint not in CACHED_ENDPOINTS:
+        return
+
+    now = time.monotonic()
+    with data_version_lock:
+        if now - data_version['checked'] < DATA_VERSION_INTERVAL:
+            return
+        data_version['checked'] = now
+
+    try:
+        with db_connection() as db_conn:
+            # Update schema if needed
+            nhltop.db_update_schema(db_conn)
+
+            version = nhltop.db_get_data_version(db_conn)
+    except mariadb.Error as err:
+        # The route reports database errors itself; the caches are kept until the next check
+        print(f'Data version check failed: Error no: {err.errno}, msg: {err.msg}')
+        return
+
+    with data_version_lock:
+        if data_version['value'] is not None and version != data_version['value']:
+            invalidate_caches()
+        data_version['value'] = version
+
+def db_error_page(err):
+    return render_template('msg.j2', title = 'Database error',
+                            message = f'<p>Error no: {err.errno}, msg: {err.msg}</p>')
+
+@app.before_request
+def start_query_count():
+    g.queries = []
+
+# Count statements of the request and report the ones over the query budget
+@app.after_request
+def check_query_budget(response):
+    queries = g.pop('queries', [])
+    endpoint = request.endpoint or 'unknown'
+    DB_REQUEST_QUERIES.labels(endpoint).observe(len(queries))
+
+    if len(queries) > DB_QUERY_BUDGET:
+        DB_QUERY_BUDGET_EXCEEDED.labels(endpoint).inc()
+        top = ', '.join(f'{count} x {template}' for (template, count) in collections.Counter(queries).most_common(3))
+        print(f'Query budget exceeded: {request.full_path} ran {len(queries)} statements '
+              f'(budget {DB_QUERY_BUDGET}): {top}')
+
+    return response
+
+# prevent cached responses (unless the route provides validators for revalidation)
 @app.after_request
 def add_header(response):
-    response.cache_control.no_cache = True
-    response.cache_control.no_store = True
+    if 'ETag' not in response.headers:
+        response.cache_control.no_cache = True
+        response.cache_control.no_store = True
 
     return response
 
+# Response for a cached page: clients have to revalidate it with ETag or Last-Modified
+def cached_response(page):
+    response = make_response(page['body'])
+    response.set_etag(page['etag'])
+    response.last_modified = page['modified']
+    response.cache_control.no_cache = True
+
+    return response.make_conditional(request)
+
+# Smaller API payloads are not worth compressing
+API_GZIP_MIN_SIZE = int(os.environ.get('API_GZIP_MIN_SIZE', 500))
+
+# Values of the database rows, which the JSON encoders don't know
+def json_default(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+# Compact JSON as bytes
+def json_dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+
+    return json.dumps(payload, default=json_default, separators=(',', ':')).encode()
+
+# API reply, which can be cached and served with json_response: the encoded payload,
+# its gzip compressed copy (if it is big enough) and the validators
+def json_page(payload):
+    body = json_dumps(payload)
+
+    return {
+        'body': body,
+        'gzip': gzip.compress(body, compresslevel=6) if len(body) >= API_GZIP_MIN_SIZE else None,
+        'etag': hashlib.sha1(body).hexdigest(),
+        'modified': datetime.now(timezone.utc).replace(microsecond=0)
+    }
+
+# JSON response for an API reply: gzip compressed if the client accepts it, 304 if the client's copy is current
+def json_response(page):
+    if page['gzip'] is not None and request.accept_encodings['gzip']:
+        response = make_response(page['gzip'])
+        response.content_encoding = 'gzip'
+        # Representations with different encodings must not share the ETag
+        response.set_etag(page['etag'] + '-gzip')
+    else:
+        response = make_response(page['body'])
+        response.set_etag(page['etag'])
+
+    response.mimetype = 'application/json'
+    response.vary.add('Accept-Encoding')
+    response.last_modified = page['modified']
+    response.cache_control.no_cache = True
+
+    return response.make_conditional(request)
+
+def json_error(err, status):
+    return json_response(json_page({'error': err})), status
+
+# Time on ice (seconds) as 'MM:SS'
+@app.template_filter('toi')
+def format_toi(seconds):
+    if seconds is None:
+        return ''
+
+    return f'{seconds // 60}:{seconds % 60:02d}'
+
 ## Main page
 @app.route('/')
 def rt_main():
-    # Try to connect to DB server
+    page = page_cache.get('main')
+    if page is not None:
+        return cached_response(page)
+
     try:
-        db_conn = nhltop.db_connect()
-    except mariadb.Error as err:
-        return render_template('msg.j2', title = 'Database error', 
-                                message = f'<p>Error no: {err.errno}, msg: {err.msg}</p>')
+        with db_connection() as db_conn:
+            # Update schema if needed
+            nhltop.db_update_schema(db_conn)
 
-    # Update schema if needed
-    nhltop.db_update_schema(db_conn)
+            seasons = nhltop.db_get_seasons(db_conn)
+            top_players = nhltop.db_get_all_top_players(db_conn)
+    except mariadb.Error as err:
+        return db_error_page(err)
 
-    seasons = nhltop.db_get_seasons(db_conn)
     content = ''
 
     if not seasons:
-        db_conn.close()
         return render_template('msg.j2', title = 'Database empty', 
                                 message = """<p>The database is empty. Click <a href="/update/">here</a>
                                              to fetch the data from the NHL API.</p>""")
@@ -41,9 +289,7 @@ def rt_main():
     for season in seasons:
         content = content + f'<h2>Season: {str(season)[:4]}-{str(season)[4:]}</h2>\n'
 
-        top_players = nhltop.db_get_top_players(db_conn, season)
-
-        for player in top_players['players']:
+        for player in top_players.get(season, {'players': []})['players']:
             gamePk = player['gamePk']
             personId = player['personId']
             fullName = player['fullName']
@@ -51,8 +297,14 @@ def rt_main():
             content = content + f'<p><a href="/stats?gamePk={gamePk}&personId={personId}">'
             content = content + f'{fullName}</a></p>'
 
-    db_conn.close()
-    return render_template('main.j2', c=content)
+    body = render_template('main.j2', c=content)
+    page = page_cache.put('main', {
+        'body': body,
+        'etag': hashlib.sha1(body.encode()).hexdigest(),
+        'modified': datetime.now(timezone.utc).replace(microsecond=0)
+    })
+
+    return cached_response(page)
 
 # Health check page
 @app.route('/check/')
@@ -66,19 +318,38 @@ def cpu_burn(seconds = 60):
     load_all_cores(duration_s=seconds, target_load=1.0)
     return render_template('msg.j2', title = 'CPU burner', message = 'CPU stress complete')
 
-# DB update page
+# Update job: fetch the seasons from the API and drop cached pages of the updated data
+def run_update(db_conn, count, force, progress):
+    # Update schema if needed
+    nhltop.db_update_schema(db_conn)
+
+    if count <= 15:
+        seasons = nhltop.get_last_seasons(count)
+    else:
+        seasons = [ str(count) ]
+
+    try:
+        stored = nhltop.update_seasons(db_conn, seasons, force=force, progress=progress)
+    except Exception:
+        stats_cache.invalidate()
+        raise
+    finally:
+        page_cache.invalidate()
+        analytics.invalidate()
+
+    # Drop statistics of the re-ingested games
+    stored_games = set(stored['gamePks'])
+    stats_cache.invalidate(lambda key: key[0] in stored_games)
+    STATS_CACHE_SIZE.set(len(stats_cache))
+
+update_jobs = jobs.UpdateJobs(db_connection, run_update)
+
+# DB update page: queues an update job (finished games, which are already stored,
+# are fetched again only with ?force=1). Identical requests share the running job.
 @app.route('/update/<int:count>')
 @app.route('/update/')
 def rt_update(count = 3):
-    # Try to connect to DB server
-    try:
-        db_conn = nhltop.db_connect()
-    except mariadb.Error as err:
-        return render_template('msg.j2', title = 'Database error',
-                                message = f'<p>Error no: {err.errno}, msg: {err.msg}</p>')
-
-    # Update schema if needed
-    nhltop.db_update_schema(db_conn)
+    force = request.args.get('force', 0, type=int) == 1
 
     if (count < 1):
         count = 1
@@ -86,59 +357,179 @@ def rt_update(count = 3):
     if (count > 15) and (count < 20062007):
         count = 15
 
-    if count <= 15:
-        seasons = nhltop.get_last_seasons(count)
-    else:
-        seasons = [ str(count) ]
+    try:
+        with db_connection() as db_conn:
+            # Update schema if needed
+            nhltop.db_update_schema(db_conn)
 
-    for season in seasons:
-        all_stars_games = nhltop.get_season_games(season, 'A')
-        playoff_games = nhltop.get_season_games(season, 'P')
+            jobId = update_jobs.submit(db_conn, count, force)
+    except mariadb.Error as err:
+        return db_error_page(err)
 
-        final_games = []
-        for game in playoff_games:
-            if str(game['gamePk'])[7] == '4':
-                final_games.append(game)
+    return render_template('msg.j2', title = 'Database update',
+                            message = f"""<p>Database update is running as job
+                              <a href="/jobs/{jobId}">{jobId}</a>.
+                              <a href="/">Return to the main page</a> to view the data.</p>"""), 202
 
-        for game in all_stars_games + final_games:
-            players = nhltop.get_game_players(game['gamePk'])
-            nhltop.db_store_game(db_conn, game)
-            for p in players:
-                nhltop.db_store_player_stat(db_conn, game, p)
+# Update job progress
+@app.route('/jobs/<jobId>')
+def rt_job(jobId):
+    try:
+        with db_connection() as db_conn:
+            # Update schema if needed
+            nhltop.db_update_schema(db_conn)
 
-    db_conn.close()
-    return render_template('msg.j2', title = 'Database updated',
-                            message = """<p>Database is updated.
-                              <a href="/">Return to the main page</a> to view.</p>""")
+            job = jobs.db_get_job(db_conn, jobId)
+    except mariadb.Error as err:
+        return jsonify({'error': f'Error no: {err.errno}, msg: {err.msg}'}), 500
+
+    if not job:
+        return jsonify({'error': 'No such job'}), 404
+
+    return jsonify(job)
+
+# Season (or all seasons) rollup of the Final games statistics as JSON: players ranked by points
+# (skaters) and save percentage (goalies), no more than ?limit=N of each
+@app.route('/analytics/<int:season>')
+@app.route('/analytics/')
+def rt_analytics(season = None):
+    limit = request.args.get('limit', 50, type=int)
 
-# Player statistics page
-@app.route('/stats', methods=['GET'])
-def rt_stats():
-    # Try to connect to DB server
     try:
-        db_conn = nhltop.db_connect()
+        rollup = analytics.get_rollup(db_connection, season)
     except mariadb.Error as err:
-        error_text = f'<p>Error no: {err.errno}, msg: {err.msg}</p>'
-        render_template('msg.j2', title = 'DB error', message = error_text)
+        return jsonify({'error': f'Error no: {err.errno}, msg: {err.msg}'}), 500
 
-    # Update schema if needed
-    nhltop.db_update_schema(db_conn)
+    return jsonify({
+        'season': rollup['season'],
+        'skaters': rollup['skaters'][:limit],
+        'goalies': rollup['goalies'][:limit]
+    })
+
+# Top players of the season's Final games by a statistic (nhltop.LEADER_STATS) as JSON,
+# read from the leaderboards built at update time (?limit=N players, 10 by default)
+@app.route('/leaders/<int:season>/<stat>')
+def rt_leaders(season, stat):
+    limit = min(max(request.args.get('limit', 10, type=int), 1), LEADERS_MAX_LIMIT)
+
+    if stat not in nhltop.LEADER_STATS:
+        return jsonify({'error': 'No such statistic', 'stats': list(nhltop.LEADER_STATS)}), 404
+
+    try:
+        with db_connection() as db_conn:
+            # Update schema if needed
+            nhltop.db_update_schema(db_conn)
 
+            leaders = nhltop.db_get_leaders(db_conn, season, stat, limit)
+    except mariadb.Error as err:
+        return jsonify({'error': f'Error no: {err.errno}, msg: {err.msg}'}), 500
+
+    return jsonify(leaders)
+
+# Player statistics page
+@app.route('/stats', methods=['GET'])
+def rt_stats():
     # Parse arguments
     gamePk = request.args.get('gamePk', 0, type=int)
     personId = request.args.get('personId', 0, type=int)
 
-    # Fetch statistics from DB
-    game_stat = nhltop.db_get_game(db_conn, gamePk)
-    player_stat = nhltop.db_get_player_stat(db_conn, personId, gamePk)
+    try:
+        (game_stat, player_stat) = get_stats(gamePk, personId)
+    except mariadb.Error as err:
+        return db_error_page(err)
 
     # Fill template with data
-    body = render_template('stats.j2', g=game_stat, p=player_stat)
+    return render_template('stats.j2', g=game_stat, p=player_stat)
+
+# Game details and player statistics in the game: from the cache or the database
+def get_stats(gamePk, personId):
+    cached = stats_cache.get((gamePk, personId))
+    if cached is not None:
+        STATS_CACHE_HITS.inc()
+        return cached
+
+    STATS_CACHE_MISSES.inc()
+    with db_connection() as db_conn:
+        # Update schema if needed
+        nhltop.db_update_schema(db_conn)
+
+        # Fetch statistics from DB
+        game_stat = nhltop.db_get_game(db_conn, gamePk)
+        player_stat = nhltop.db_get_player_stat(db_conn, personId, gamePk)
+
+    # Unknown players are not cached, they may appear after the next update
+    if player_stat:
+        stats_cache.put((gamePk, personId), (game_stat, player_stat))
+        STATS_CACHE_SIZE.set(len(stats_cache))
+
+    return (game_stat, player_stat)
+
+## JSON API (v1): the data of the pages for dashboards and scripts.
+## Replies are compact JSON with ETag validators; seasons and top players are cached like the main page.
+
+# Seasons stored in the database
+@app.route('/api/v1/seasons')
+def rt_api_seasons():
+    page = page_cache.get('api_seasons')
+    if page is None:
+        try:
+            with db_connection() as db_conn:
+                # Update schema if needed
+                nhltop.db_update_schema(db_conn)
+
+                seasons = nhltop.db_get_seasons(db_conn)
+        except mariadb.Error as err:
+            return json_error(f'Error no: {err.errno}, msg: {err.msg}', 500)
+
+        page = page_cache.put('api_seasons', json_page({'seasons': sorted(seasons)}))
+
+    return json_response(page)
+
+# Players, who played both All-stars and Final games of the season, with their last Final game
+@app.route('/api/v1/top/<int:season>')
+def rt_api_top(season):
+    page = page_cache.get(('api_top', season))
+    if page is None:
+        try:
+            with db_connection() as db_conn:
+                # Update schema if needed
+                nhltop.db_update_schema(db_conn)
+
+                top_players = nhltop.db_get_top_players(db_conn, season)
+        except mariadb.Error as err:
+            return json_error(f'Error no: {err.errno}, msg: {err.msg}', 500)
+
+        page = page_cache.put(('api_top', season), json_page({'season': season, 'players': top_players['players']}))
+
+    return json_response(page)
+
+# Game details and player statistics in the game (?gamePk=&personId=).
+# Encoded replies are kept in the statistics cache next to the statistics (keys start with gamePk,
+# so they are dropped with them when the game is re-ingested).
+@app.route('/api/v1/stats')
+def rt_api_stats():
+    gamePk = request.args.get('gamePk', 0, type=int)
+    personId = request.args.get('personId', 0, type=int)
+
+    page = stats_cache.get((gamePk, personId, 'json'))
+    if page is not None:
+        return json_response(page)
+
+    try:
+        (game_stat, player_stat) = get_stats(gamePk, personId)
+    except mariadb.Error as err:
+        return json_error(f'Error no: {err.errno}, msg: {err.msg}', 500)
+
+    if not player_stat:
+        return json_error('No such player in the game', 404)
 
-    db_conn.close()
+    page = stats_cache.put((gamePk, personId, 'json'), json_page({'gamePk': gamePk, 'personId': personId,
+                                                                  'game': game_stat, 'player': player_stat}))
+    STATS_CACHE_SIZE.set(len(stats_cache))
 
-    return body
+    return json_response(page)
 
 
+# Development server (production runs gunicorn -c gunicorn.conf.py app:app)
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+import subprocess
+import argparse
+import resource
+import tempfile
+import sqlite3
+import json
+import time
+import sys
+import os
+
+# Ingest benchmark: updates the last 1, 3 and 15 seasons from the local fake NHL API (fakeapi.py)
+# into a throwaway database and reports end-to-end time, requests/sec, rows/sec and peak RSS.
+# Every scenario runs in its own process, so the peak RSS and the HTTP counters are its own.
+#
+#   benchmark.py [--seasons 1,3,15] [--latency 0.05] [--throttle 0.02] [--db sqlite|mariadb]
+#                [--save baseline.json] [--compare baseline.json [--tolerance 0.25]]
+#
+# With --leaders the reads of the leaderboards (top --limit players of every season by every
+# statistic) are timed instead, against the same top N computed by a sort per request.
+#
+#   benchmark.py --leaders [--seasons 15] [--repeat 20] [--limit 10]
+
+# Database used with --db mariadb (created and dropped by every scenario)
+BENCH_DB_NAME = os.environ.get('NHL_BENCH_DB_NAME', 'nhltop_bench')
+
+# Scenario results compared with a baseline: key and whether bigger is better
+COMPARED = [('seconds', False), ('requests_per_sec', True), ('rows_per_sec', True), ('peak_rss_mb', False)]
+
+# Leaderboard results compared with a baseline
+LEADERS_COMPARED = [('leaders_ms', False)]
+
+# Top N computed from the statistics tables by every request (the baseline of the leaderboards)
+LEADERS_ON_DEMAND = """
+    SELECT s.personId, p.fullName, SUM({expression}) AS value
+    FROM {table} s INNER JOIN games g ON s.gamePk = g.gamePk
+         INNER JOIN persons p ON s.personId = p.personId
+    WHERE g.gameType = 'P' AND g.season = ?
+    GROUP BY s.personId, p.fullName
+    ORDER BY value DESC, s.personId
+    LIMIT ?"""
+
+# SQLite stand-in: a fresh database file with the current schema
+def sqlite_connect(path):
+    import nhltop
+
+    conn = sqlite3.connect(path, check_same_thread=False)
+    nhltop.db_apply_migrations(conn, 0)
+
+    return conn
+
+# Throwaway MariaDB database on the server from DB_HOST/DB_USER/DB_PASSWORD
+def mariadb_connect():
+    import nhltop
+
+    conn = nhltop.db_connect()
+    cur = conn.cursor()
+    cur.execute(f'DROP DATABASE IF EXISTS {BENCH_DB_NAME}')
+    cur.execute(f'CREATE DATABASE {BENCH_DB_NAME}')
+    cur.execute(f'USE {BENCH_DB_NAME}')
+    nhltop.db_update_schema(conn)
+
+    return conn
+
+def mariadb_drop(conn):
+    conn.cursor().execute(f'DROP DATABASE IF EXISTS {BENCH_DB_NAME}')
+    conn.close()
+
+# Single scenario (in a child process): update the last count seasons, returns the measurements
+def run_scenario(count, db, workers):
+    import nhltop
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if db == 'mariadb':
+            conn = mariadb_connect()
+        else:
+            conn = sqlite_connect(os.path.join(tmp_dir, 'nhltop.db'))
+
+        start = time.perf_counter()
+        seasons = nhltop.get_last_seasons(count)
+        stored = nhltop.update_seasons(conn, seasons, workers=workers)
+        seconds = time.perf_counter() - start
+
+        if db == 'mariadb':
+            mariadb_drop(conn)
+        else:
+            conn.close()
+
+    http = nhltop.get_http_stats()
+
+    result = {}
+    result['seasons'] = count
+    result['games'] = stored['games']
+    result['rows'] = stored['rows']
+    result['requests'] = http['requests']
+    result['connections'] = http['connections']
+    result['seconds'] = round(seconds, 3)
+    result['db_seconds'] = round(stored['seconds'], 3)
+    result['requests_per_sec'] = round(http['requests'] / seconds, 1)
+    result['rows_per_sec'] = round(stored['rows'] / seconds, 1)
+    # ru_maxrss is in kilobytes on Linux
+    result['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    return result
+
+# Leaderboard reads of the last count seasons (in this process): milliseconds per top N read
+# from the leaderboards and computed on demand, per statistic
+def run_leaders(api, count, db, repeat, limit):
+    import nhltop
+
+    nhltop.API_URL = api.url
+    nhltop.http_cache = None
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if db == 'mariadb':
+            conn = mariadb_connect()
+        else:
+            conn = sqlite_connect(os.path.join(tmp_dir, 'nhltop.db'))
+
+        nhltop.update_seasons(conn, nhltop.get_last_seasons(count))
+        seasons = nhltop.db_get_seasons(conn)
+        cur = conn.cursor()
+
+        for (stat, (table, expression)) in nhltop.LEADER_STATS.items():
+            query = LEADERS_ON_DEMAND.format(table=table, expression=expression)
+
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for season in seasons:
+                    leaders = nhltop.db_get_leaders(conn, season, stat, limit)
+            leaders_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for season in seasons:
+                    cur.execute(query, (season, limit))
+                    on_demand = cur.fetchall()
+            on_demand_seconds = time.perf_counter() - start
+
+            # Both return the same values of the last season (ties may be ordered differently)
+            if [leader['value'] for leader in leaders['leaders']] != [value for (_, _, value) in on_demand]:
+                raise RuntimeError(f'Leaderboard of {stat} differs from the computed one')
+
+            reads = repeat * len(seasons)
+
+            result = {}
+            result['stat'] = stat
+            result['reads'] = reads
+            result['leaders_ms'] = round(leaders_seconds * 1000 / reads, 4)
+            result['on_demand_ms'] = round(on_demand_seconds * 1000 / reads, 4)
+            result['speedup'] = round(on_demand_seconds / leaders_seconds, 1) if leaders_seconds > 0 else 0
+            results.append(result)
+
+        if db == 'mariadb':
+            mariadb_drop(conn)
+        else:
+            conn.close()
+
+    return results
+
+# Run the scenario in a fresh interpreter pointed to the fake API, with the disk cache off
+def spawn_scenario(api, count, args):
+    env = dict(os.environ, NHL_API_URL=api.url)
+    env.pop('NHL_CACHE_DIR', None)
+
+    command = [sys.executable, os.path.abspath(__file__), '--run', str(count), '--db', args.db]
+    if args.workers:
+        command += ['--workers', str(args.workers)]
+
+    reply = subprocess.run(command, env=env, check=True, stdout=subprocess.PIPE, text=True)
+
+    return json.loads(reply.stdout.splitlines()[-1])
+
+# Returns the list of regressions (worse than the baseline by more than tolerance).
+# Results are matched with the baseline ones by the key field; compared lists (field, bigger_is_better).
+def compare(results, baseline, tolerance, key='seasons', compared=COMPARED):
+    regressions = []
+    baseline = {entry[key]: entry for entry in baseline['results']}
+
+    for result in results:
+        base = baseline.get(result[key])
+        if base is None:
+            continue
+
+        for (field, bigger_is_better) in compared:
+            if not base.get(field):
+                continue
+            change = (result[field] - base[field]) / base[field]
+            if bigger_is_better:
+                change = -change
+            if change > tolerance:
+                regressions.append(f"{key} {result[key]}: {field} {base[field]} -> {result[field]} "
+                                   f"({change * 100:.0f}% worse)")
+
+    return regressions
+
+def print_results(results):
+    print(f"{'seasons':>8} {'games':>6} {'rows':>7} {'requests':>9} {'seconds':>8} "
+          f"{'req/s':>8} {'rows/s':>9} {'RSS MB':>7}")
+    for r in results:
+        print(f"{r['seasons']:>8} {r['games']:>6} {r['rows']:>7} {r['requests']:>9} {r['seconds']:>8.2f} "
+              f"{r['requests_per_sec']:>8.1f} {r['rows_per_sec']:>9.1f} {r['peak_rss_mb']:>7.1f}")
+
+def print_leaders(results):
+    print(f"{'stat':<16} {'reads':>6} {'leaders ms':>11} {'on demand ms':>13} {'speedup':>8}")
+    for r in results:
+        print(f"{r['stat']:<16} {r['reads']:>6} {r['leaders_ms']:>11.3f} {r['on_demand_ms']:>13.3f} "
+              f"{r['speedup']:>7.1f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the NHL data update')
+    parser.add_argument('--seasons', default='1,3,15', help='comma separated season counts')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every API reply')
+    parser.add_argument('--throttle', type=float, default=0.0, help='share of API requests answered with 429')
+    parser.add_argument('--fixtures', default=os.environ.get('NHL_FIXTURES'),
+                        help='directory with recorded API replies')
+    parser.add_argument('--db', choices=['sqlite', 'mariadb'], default='sqlite')
+    parser.add_argument('--workers', type=int, help='parallel boxscore fetches (NHL_FETCH_WORKERS)')
+    parser.add_argument('--save', help='write the results to this file (JSON)')
+    parser.add_argument('--compare', help='baseline results file; exit with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed regression (share)')
+    parser.add_argument('--leaders', action='store_true', help='time the leaderboard reads instead of the update')
+    parser.add_argument('--repeat', type=int, default=20, help='reads of every leaderboard (--leaders)')
+    parser.add_argument('--limit', type=int, default=10, help='players per leaderboard read (--leaders)')
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_scenario(args.run, args.db, args.workers)))
+        return 0
+
+    if args.db == 'mariadb':
+        print(f'Warning: database {BENCH_DB_NAME} on {os.environ.get("DB_HOST")} will be dropped', file=sys.stderr)
+
+    import fakeapi
+    api = fakeapi.FakeNHLAPI(latency=args.latency, throttle=args.throttle, fixtures=args.fixtures).start()
+
+    results = []
+    try:
+        for count in [int(count) for count in args.seasons.split(',')]:
+            if args.leaders:
+                results += run_leaders(api, count, args.db, args.repeat, args.limit)
+            else:
+                results.append(spawn_scenario(api, count, args))
+    finally:
+        api.stop()
+
+    if args.leaders:
+        print_leaders(results)
+    else:
+        print_results(results)
+        print(f'API: {api.requests} requests, {api.throttled} throttled (latency {args.latency} s)')
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'db': args.db,
+        'latency': args.latency,
+        'throttle': args.throttle,
+        'results': results
+    }
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            if args.leaders:
+                regressions = compare(results, json.load(f), args.tolerance, 'stat', LEADERS_COMPARED)
+            else:
+                regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+        if regressions:
+            return 1
+        print('No regressions')
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+from collections import OrderedDict
+import threading
+import time
+
+# In-process cache, which entries expire after ttl seconds or when invalidated
+class TTLCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    # Returns cached value or None if it is missing or expired
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            (expires, value) = entry
+            if time.monotonic() >= expires:
+                del self.entries[key]
+                return None
+
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+
+        return value
+
+    # Drop one entry or the whole cache
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+# Bounded in-process cache, which drops the least recently used entries first
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Returns cached value or None if it is missing
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return value
+
+    def put(self, key, value):
+        if self.maxsize < 1:
+            return value
+
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+        return value
+
+    # Drop entries, which keys match the predicate (or the whole cache)
+    def invalidate(self, predicate=None):
+        with self.lock:
+            if predicate is None:
+                self.entries.clear()
+                return
+
+            for key in [key for key in self.entries if predicate(key)]:
+                del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+from contextlib import contextmanager
+import threading
+import time
+import mariadb
+
+# Raised when no connection gets free in time
+class PoolTimeout(mariadb.PoolError):
+    errno = 0
+    msg = 'Timed out waiting for a free database connection'
+
+# Process-wide pool of database connections.
+# Idle connections are checked with ping on checkout and reopened if the server dropped them.
+class ConnectionPool:
+    def __init__(self, connect, min_size=1, max_size=10, timeout=10):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.timeout = timeout
+
+        self.idle = []
+        self.size = 0       # open connections (idle and in use)
+        self.in_use = 0
+        self.filled = False
+        self.cond = threading.Condition()
+
+    # Open min_size connections on first use (errors are left to the first checkout)
+    def fill(self):
+        with self.cond:
+            if self.filled:
+                return
+            self.filled = True
+
+        for _ in range(self.min_size):
+            with self.cond:
+                if self.size >= self.min_size:
+                    break
+                self.size += 1
+            try:
+                conn = self.connect()
+            except mariadb.Error:
+                with self.cond:
+                    self.size -= 1
+                    self.cond.notify()
+                break
+            with self.cond:
+                self.idle.append(conn)
+                self.cond.notify()
+
+    # Take a connection from the pool, open a new one if there is room, or wait for a free one
+    def acquire(self):
+        self.fill()
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            conn = None
+            with self.cond:
+                while not self.idle and self.size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout()
+                    self.cond.wait(remaining)
+
+                if self.idle:
+                    conn = self.idle.pop()
+                else:
+                    self.size += 1
+                self.in_use += 1
+
+            if conn is None:
+                try:
+                    return self.connect()
+                except mariadb.Error:
+                    self.forget()
+                    raise
+
+            # Health check, reconnect if the connection is dead
+            try:
+                conn.ping()
+                return conn
+            except mariadb.Error:
+                self.close(conn)
+                self.forget()
+
+    # Return the connection to the pool (broken ones are closed instead)
+    def release(self, conn, discard=False):
+        if not discard:
+            try:
+                # End the transaction, so the next user sees fresh data
+                conn.rollback()
+            except mariadb.Error:
+                discard = True
+
+        if discard:
+            self.close(conn)
+            self.forget()
+            return
+
+        with self.cond:
+            self.in_use -= 1
+            self.idle.append(conn)
+            self.cond.notify()
+
+    # Account a connection, which is not in the pool anymore
+    def forget(self):
+        with self.cond:
+            self.size -= 1
+            self.in_use -= 1
+            self.cond.notify()
+
+    def close(self, conn):
+        try:
+            conn.close()
+        except mariadb.Error:
+            pass
+
+    # Connection for a 'with' block; it is discarded if a database error escapes the block
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        discard = False
+        try:
+            yield conn
+        except mariadb.Error:
+            discard = True
+            raise
+        finally:
+            self.release(conn, discard)
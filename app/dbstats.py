@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+import threading
+import time
+import os
+
+# Statements slower than this are printed to the slow query log (0 - disabled)
+SLOW_QUERY_MS = float(os.environ.get('DB_SLOW_QUERY_MS', 0))
+
+# Observers of the executed statements: observer(template, seconds, rows).
+# rows is the row count reported by the driver (-1 if it is unknown, e.g. SELECT on SQLite).
+query_observers = []
+query_observers_lock = threading.Lock()
+
+def add_query_observer(observer):
+    with query_observers_lock:
+        query_observers.append(observer)
+
+def remove_query_observer(observer):
+    with query_observers_lock:
+        query_observers.remove(observer)
+
+# Statement text with collapsed whitespace; parameters are passed separately,
+# so the same statement always has the same template
+def query_template(statement, length=100):
+    template = ' '.join(statement.split())
+    if len(template) > length:
+        template = template[:length - 3] + '...'
+
+    return template
+
+def record_query(statement, seconds, rows):
+    template = query_template(statement)
+
+    if SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS:
+        count = f'{rows} rows' if rows >= 0 else 'rows unknown'
+        print(f'Slow query: {seconds * 1000:.1f} ms, {count}: {template}')
+
+    for observer in list(query_observers):
+        observer(template, seconds, rows)
+
+# Cursor, which times execute() and executemany() (fetching rows of buffered cursors costs nothing,
+# so the execution time covers the whole query); everything else goes to the driver cursor
+class InstrumentedCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, statement, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.cursor.execute(statement, *args, **kwargs)
+        finally:
+            record_query(statement, time.perf_counter() - start, self.cursor.rowcount)
+
+    def executemany(self, statement, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.cursor.executemany(statement, *args, **kwargs)
+        finally:
+            record_query(statement, time.perf_counter() - start, self.cursor.rowcount)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+# Database connection, which cursors are instrumented
+class InstrumentedConnection:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self.conn.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
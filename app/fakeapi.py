@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import threading
+import random
+import json
+import time
+import sys
+import os
+
+# Local fake of the NHL API (seasons, schedule and boxscore endpoints) for tests and benchmarks.
+# Replies are read from recorded fixtures if a fixtures directory is given and has the file
+# (seasons_current.json, seasons.json, schedule_<season>_<type>.json, boxscore_<gamePk>.json),
+# otherwise they are generated: the data is synthetic, but shaped and sized like the real replies.
+
+FIRST_SEASON = 2005
+LAST_SEASON = 2022      # current (unfinished) season starts this year
+TEAMS = 32
+ROSTER = 23             # players dressed for a game, the last one is a scratch (no stats)
+
+SKATER_STATS = ['assists', 'goals', 'shots', 'hits', 'powerPlayGoals', 'powerPlayAssists',
+                'penaltyMinutes', 'faceOffWins', 'faceoffTaken', 'takeaways', 'giveaways',
+                'shortHandedGoals', 'shortHandedAssists', 'blocked', 'plusMinus']
+
+def season_id(year):
+    return f'{year}{year + 1}'
+
+def team(team_id):
+    return {'id': team_id, 'name': f'Team {team_id}', 'link': f'/api/v1/teams/{team_id}'}
+
+def game_state(year):
+    return 'Final' if year < LAST_SEASON else 'Preview'
+
+def seasons_reply():
+    return {'seasons': [{'seasonId': season_id(year), 'regularSeasonStartDate': f'{year}-10-01'}
+                        for year in range(FIRST_SEASON, LAST_SEASON + 1)]}
+
+def current_season_reply():
+    return {'seasons': [{'seasonId': season_id(LAST_SEASON), 'regularSeasonStartDate': f'{LAST_SEASON}-10-01'}]}
+
+def schedule_game(gamePk, year, game_type, away, home, rnd):
+    return {
+        'gamePk': gamePk,
+        'link': f'/api/v1/game/{gamePk}/feed/live',
+        'gameType': game_type,
+        'season': season_id(year),
+        'gameDate': f'{year + 1}-06-01T00:00:00Z',
+        'status': {'abstractGameState': game_state(year), 'codedGameState': '7',
+                   'detailedState': game_state(year), 'statusCode': '7'},
+        'teams': {
+            'away': {'leagueRecord': {'wins': 0, 'losses': 0, 'type': 'league'},
+                     'score': rnd.randrange(7), 'team': team(away)},
+            'home': {'leagueRecord': {'wins': 0, 'losses': 0, 'type': 'league'},
+                     'score': rnd.randrange(7), 'team': team(home)}
+        },
+        'venue': {'id': 5000 + home, 'name': f'Arena {home}'},
+        'content': {'link': f'/api/v1/game/{gamePk}/content'}
+    }
+
+# All-Star games (3 on 3 tournament, with the finalists among the teams)
+# or the whole playoffs: 4 rounds, every series lasts 4-7 games
+def schedule_reply(season, game_type):
+    year = int(season[:4])
+    rnd = random.Random(f'{season}{game_type}')
+    dates = []
+
+    if game_type == 'A':
+        for idx in range(3):
+            game = schedule_game(int(f'{year}04064{idx + 1}'), year, 'A', 7 + idx * 2, 8 + idx * 2, rnd)
+            dates.append({'date': f'{year + 1}-02-01', 'games': [game]})
+    else:
+        day = 0
+        for rnd_no, series_count in ((1, 8), (2, 4), (3, 2), (4, 1)):
+            for series in range(1, series_count + 1):
+                away = (series * 2 + rnd_no) % TEAMS + 1
+                home = (series * 2 + rnd_no + 1) % TEAMS + 1
+                for game_no in range(1, rnd.randrange(4, 8) + 1):
+                    gamePk = int(f'{year}030{rnd_no}{series}{game_no}')
+                    game = schedule_game(gamePk, year, 'P', away, home, rnd)
+                    dates.append({'date': f'{year + 1}-04-{1 + day % 30:02d}', 'games': [game]})
+                    day += 1
+
+    return {'totalGames': len(dates), 'dates': dates}
+
+def boxscore_player(person_id, number, position, rnd):
+    person = {
+        'id': person_id,
+        'fullName': f'Player {person_id}',
+        'link': f'/api/v1/people/{person_id}',
+        'birthDate': f'19{80 + person_id % 20}-0{1 + person_id % 9}-1{person_id % 10}',
+        'birthCity': f'City {person_id % 50}',
+        'birthCountry': ['CAN', 'USA', 'SWE', 'FIN', 'RUS'][person_id % 5],
+        'nationality': ['CAN', 'USA', 'SWE', 'FIN', 'RUS'][person_id % 5]
+    }
+    if position == 'Goalie':
+        shots = rnd.randrange(20, 40)
+        saves = shots - rnd.randrange(0, 6)
+        stats = {'goalieStats': {
+            'timeOnIce': f'{rnd.randrange(55, 65)}:{rnd.randrange(60):02d}',
+            'assists': 0, 'goals': 0, 'pim': 0, 'shots': shots, 'saves': saves,
+            'powerPlaySaves': rnd.randrange(5), 'shortHandedSaves': 0, 'evenSaves': saves - 3,
+            'shortHandedShotsAgainst': 0, 'evenShotsAgainst': shots - 3, 'powerPlayShotsAgainst': 3,
+            'decision': 'W', 'savePercentage': round(saves * 100 / shots, 2)
+        }}
+    elif position is None:
+        stats = {}
+    else:
+        skater = {name: rnd.randrange(3) for name in SKATER_STATS}
+        skater['plusMinus'] = rnd.randrange(-3, 4)
+        skater['timeOnIce'] = f'{rnd.randrange(8, 26)}:{rnd.randrange(60):02d}'
+        skater['evenTimeOnIce'] = f'{rnd.randrange(6, 20)}:{rnd.randrange(60):02d}'
+        skater['powerPlayTimeOnIce'] = f'{rnd.randrange(4)}:{rnd.randrange(60):02d}'
+        skater['shortHandedTimeOnIce'] = f'{rnd.randrange(3)}:{rnd.randrange(60):02d}'
+        stats = {'skaterStats': skater}
+
+    return {
+        'person': person,
+        'jerseyNumber': str(number),
+        'position': {'code': (position or 'Center')[0], 'name': position or 'Center'},
+        'stats': stats
+    }
+
+def boxscore_team(team_id, rnd):
+    players = {}
+    for idx in range(ROSTER):
+        person_id = 8470000 + team_id * 100 + idx
+        if idx == ROSTER - 1:
+            position = None
+        elif idx < 2:
+            position = 'Goalie'
+        else:
+            position = ['Center', 'Left Wing', 'Right Wing', 'Defenseman'][idx % 4]
+        players[f'ID{person_id}'] = boxscore_player(person_id, idx + 1, position, rnd)
+
+    return {'team': team(team_id), 'teamStats': {}, 'players': players}
+
+def boxscore_reply(gamePk):
+    rnd = random.Random(gamePk)
+    digits = str(gamePk)
+    if digits[4:6] == '04':
+        away = 7 + (int(digits[-1]) - 1) * 2
+    else:
+        away = (int(digits[8]) * 2 + int(digits[7])) % TEAMS + 1
+    home = away % TEAMS + 1
+
+    return {'teams': {'away': boxscore_team(away, rnd), 'home': boxscore_team(home, rnd)}}
+
+class FakeNHLHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        api = self.server.api
+        api.count_request()
+
+        if api.latency:
+            time.sleep(api.latency)
+
+        if api.should_throttle():
+            self.reply(429, b'{}')
+            return
+
+        body = api.reply_body(self.path)
+        if body is None:
+            self.reply(404, b'{}')
+        else:
+            self.reply(200, body)
+
+    def reply(self, code, data):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+# Fake API server running in a background thread.
+# latency - seconds added to every reply, throttle - share of requests answered with 429.
+class FakeNHLAPI:
+    def __init__(self, latency=0, throttle=0, fixtures=None, port=0):
+        self.latency = latency
+        self.throttle = throttle
+        self.fixtures = fixtures
+        self.requests = 0
+        self.throttled = 0
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), FakeNHLHandler)
+        self.server.daemon_threads = True
+        self.server.api = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}/api/v1/'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def should_throttle(self):
+        with self.lock:
+            if self.throttle and self.random.random() < self.throttle:
+                self.throttled += 1
+                return True
+        return False
+
+    # Reply for the request path, None if it is unknown
+    def reply_body(self, path):
+        url = urlsplit(path)
+        endpoint = url.path.split('/api/v1/', 1)[-1]
+        query = parse_qs(url.query)
+
+        if endpoint == 'seasons/current':
+            return self.fixture('seasons_current.json', current_season_reply)
+        if endpoint == 'seasons/':
+            return self.fixture('seasons.json', seasons_reply)
+        if endpoint == 'schedule':
+            season = query['season'][0]
+            game_type = query['gameType'][0]
+            return self.fixture(f'schedule_{season}_{game_type}.json',
+                                lambda: schedule_reply(season, game_type))
+        if endpoint.startswith('game/') and endpoint.endswith('/boxscore'):
+            gamePk = int(endpoint.split('/')[1])
+            return self.fixture(f'boxscore_{gamePk}.json', lambda: boxscore_reply(gamePk))
+
+        return None
+
+    def fixture(self, name, generate):
+        if self.fixtures:
+            try:
+                with open(os.path.join(self.fixtures, name), 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                pass
+
+        return json.dumps(generate()).encode()
+
+# Serve the fake API from the command line: fakeapi.py [port [latency [throttle]]]
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+    throttle = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+    api = FakeNHLAPI(latency=latency, throttle=throttle, fixtures=os.environ.get('NHL_FIXTURES'), port=port)
+    print(f'Fake NHL API: {api.url}')
+    api.server.serve_forever()
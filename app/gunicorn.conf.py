@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+from prometheus_flask_exporter.multiprocess import GunicornInternalPrometheusMetrics
+import shutil
+import sys
+import math
+import os
+
+# Production server settings: gunicorn -c gunicorn.conf.py app:app
+# Workers are forked by the master process, every worker serves requests with a pool of threads.
+# 'kill -HUP <master pid>' reloads the code gracefully: new workers are started, old ones
+# finish the requests in progress (up to graceful_timeout seconds) and exit.
+# Every worker has its own in-process caches; they follow the data version in the database
+# (see check_data_version in app.py), so updates run by one worker reach the others in seconds.
+# Update jobs run in a thread of a worker: the ones of an exiting worker are marked failed.
+
+# CPUs available to the container: cgroup CPU limit (v2 or v1) or the CPUs of the process
+def cpu_limit():
+    try:
+        with open('/sys/fs/cgroup/cpu.max', encoding='utf-8') as f:
+            (quota, period) = f.read().split()
+        if quota != 'max':
+            return max(1, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', encoding='utf-8') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us', encoding='utf-8') as f:
+            period = int(f.read())
+        if quota > 0:
+            return max(1, math.ceil(quota / period))
+    except (OSError, ValueError):
+        pass
+
+    return len(os.sched_getaffinity(0))
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+# One worker per CPU (at least 2, so a busy worker doesn't stall the pod); threads wait for the DB and the API
+workers = int(os.environ.get('GUNICORN_WORKERS', 0)) or max(2, cpu_limit())
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+# Workers import the app themselves, so a reload picks up the new code
+preload_app = False
+
+accesslog = '-'
+
+# Metrics of all the workers are kept in PROMETHEUS_MULTIPROC_DIR and merged on /metrics
+def on_starting(server):
+    path = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        # Drop the files of a previous run
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        GunicornInternalPrometheusMetrics.mark_process_dead_on_child_exit(worker.pid)
+
+# Called in the worker process, which is exiting (reload, restart or shutdown; a killed worker
+# can't do that, its jobs are taken for dead after NHL_JOB_STALE_SECONDS)
+def worker_exit(server, worker):
+    webapp = sys.modules.get('app')
+    if webapp is None:
+        return
+
+    try:
+        webapp.update_jobs.abandon(f'Server worker {worker.pid} exited')
+    except Exception as err:
+        print(f'Update jobs of worker {worker.pid} are not marked failed: {err}')
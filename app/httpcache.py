@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+import threading
+import hashlib
+import shutil
+import gzip
+import json
+import time
+import os
+
+# ttl of the entries, which never expire (e.g. boxscores of finished games)
+IMMUTABLE = -1
+
+# On-disk cache of API replies, named by the hash of the URL. Every entry consists of
+# a small JSON file with the validators (ETag, Last-Modified) and expiration policy,
+# and of the gzip compressed reply body, which can be read (or parsed) as a stream.
+# Every stored body gets a new file name, which the JSON file refers to; the JSON file
+# is replaced last, so readers (and crashes) never pair a body with validators of another one.
+class HTTPCache:
+    def __init__(self, path):
+        self.path = path
+
+    def entry_path(self, url):
+        digest = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.path, digest[:2], digest)
+
+    def body_path(self, entry):
+        return os.path.join(os.path.dirname(self.entry_path(entry['url'])), entry['body'])
+
+    # Returns entry details for the URL or None
+    def load(self, url):
+        path = self.entry_path(url)
+        try:
+            with open(path + '.json', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # Protect from (very unlikely) hash collisions, from lost bodies and from entries
+        # of the older layout without a body name
+        if entry.get('url') != url or 'body' not in entry or not os.path.exists(self.body_path(entry)):
+            return None
+
+        return entry
+
+    # Binary file object with the decompressed reply body of a loaded entry.
+    # If the entry was replaced meanwhile (and its body removed), the new body is opened.
+    def open_body(self, entry):
+        while True:
+            try:
+                return gzip.open(self.body_path(entry), 'rb')
+            except FileNotFoundError:
+                replaced = self.load(entry['url'])
+                if replaced is None or replaced['body'] == entry['body']:
+                    raise
+                entry = replaced
+
+    # Reply body of a loaded entry parsed as JSON
+    def read_body(self, entry):
+        with self.open_body(entry) as f:
+            return json.load(f)
+
+    # Store reply body (bytes or a binary file object, which is copied in chunks) and its details
+    def store(self, url, body, ttl, etag=None, last_modified=None):
+        path = self.entry_path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        previous = self.load(url)
+
+        # Write to a temporary file first, so concurrent readers never see a partial body
+        name = f'{os.path.basename(path)}.{os.urandom(8).hex()}.body.gz'
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with gzip.open(tmp_path, 'wb') as f:
+            if isinstance(body, bytes):
+                f.write(body)
+            else:
+                shutil.copyfileobj(body, f)
+        os.replace(tmp_path, os.path.join(os.path.dirname(path), name))
+
+        entry = self.write_entry(url, name, ttl, etag, last_modified)
+
+        # Readers, which have the previous body open, keep reading it
+        if previous is not None:
+            try:
+                os.remove(self.body_path(previous))
+            except OSError:
+                pass
+
+        return entry
+
+    # Store details of a loaded entry only (e.g. the body was revalidated with a conditional GET)
+    def touch(self, entry, ttl):
+        return self.write_entry(entry['url'], entry['body'], ttl, entry['etag'], entry['lastModified'])
+
+    def write_entry(self, url, body, ttl, etag, last_modified):
+        path = self.entry_path(url)
+        entry = {
+            'url': url,
+            'body': body,
+            'stored': time.time(),
+            'ttl': ttl,
+            'etag': etag,
+            'lastModified': last_modified
+        }
+
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path + '.json')
+
+        return entry
+
+    # Entry can be used without asking the server
+    def is_fresh(self, entry):
+        if entry['ttl'] == IMMUTABLE:
+            return True
+
+        return time.time() - entry['stored'] < entry['ttl']
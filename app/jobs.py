@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+import threading
+import queue
+import time
+import mariadb
+import uuid
+import os
+
+# Active jobs, which didn't report progress for so long, are considered dead (e.g. the pod was killed)
+JOB_STALE_SECONDS = int(os.environ.get('NHL_JOB_STALE_SECONDS', 600))
+
+# Seconds to wait for another process registering a job
+JOB_LOCK_TIMEOUT = 10
+
+# Jobs of all the processes and replicas run one at a time under this database lock (they write
+# the same rows); waiting jobs check the lock and report they are alive every JOB_WAIT_INTERVAL seconds
+UPDATE_LOCK = 'nhltop_update'
+JOB_WAIT_INTERVAL = 5
+
+# Raised when another process holds the job registration lock for too long
+class JobLockTimeout(mariadb.OperationalError):
+    errno = 0
+    msg = 'Timed out waiting for the update job lock'
+
+# Returns id of a queued or running job with the same parameters, or None
+def db_find_active_job(conn, count, force):
+    cur = conn.cursor()
+
+    cur.execute("""
+        SELECT jobId
+        FROM update_jobs
+        WHERE status IN ('queued', 'running') AND seasonCount = ? AND forced = ? AND updatedAt > ?
+        ORDER BY createdAt LIMIT 1""",
+        (count, int(force), time.time() - JOB_STALE_SECONDS)
+    )
+
+    for (jobId,) in cur:
+        return jobId
+
+    return None
+
+def db_create_job(conn, count, force):
+    cur = conn.cursor()
+    jobId = uuid.uuid4().hex
+    now = time.time()
+
+    cur.execute("""
+        INSERT INTO update_jobs (jobId, seasonCount, forced, status, gamesFetched, rowsWritten,
+                                 createdAt, updatedAt)
+        VALUES (?, ?, ?, 'queued', 0, 0, ?, ?)""",
+        (jobId, count, int(force), now, now)
+    )
+    conn.commit()
+
+    return jobId
+
+def db_update_job(conn, jobId, **fields):
+    fields['updatedAt'] = time.time()
+    columns = ', '.join(f'{name} = ?' for name in fields)
+
+    cur = conn.cursor()
+    cur.execute(f'UPDATE update_jobs SET {columns} WHERE jobId = ?', tuple(fields.values()) + (jobId,))
+    conn.commit()
+
+# Mark queued jobs as alive, so they are not taken for dead while they wait for their turn
+def db_touch_queued_jobs(conn, jobIds):
+    if not jobIds:
+        return
+
+    cur = conn.cursor()
+    cur.execute(f"""
+        UPDATE update_jobs SET updatedAt = ?
+        WHERE status = 'queued' AND jobId IN ({', '.join('?' * len(jobIds))})""",
+        (time.time(),) + tuple(jobIds)
+    )
+    conn.commit()
+
+# Mark the jobs failed, unless they are finished already
+def db_fail_jobs(conn, jobIds, error):
+    now = time.time()
+    cur = conn.cursor()
+    cur.execute(f"""
+        UPDATE update_jobs SET status = 'failed', finishedAt = ?, updatedAt = ?, error = ?
+        WHERE status IN ('queued', 'running') AND jobId IN ({', '.join('?' * len(jobIds))})""",
+        (now, now, error) + tuple(jobIds)
+    )
+    conn.commit()
+
+# Returns job details or an empty dict if there is no such job
+def db_get_job(conn, jobId):
+    cur = conn.cursor()
+    result = {}
+
+    cur.execute("""
+        SELECT jobId, seasonCount, forced, status, gamesFetched, rowsWritten,
+               createdAt, startedAt, finishedAt, error
+        FROM update_jobs
+        WHERE jobId = ?""",
+        (jobId,)
+    )
+
+    for (jobId, seasonCount, forced, status, gamesFetched, rowsWritten,
+         createdAt, startedAt, finishedAt, error) in cur:
+
+        result['jobId'] = jobId
+        result['count'] = seasonCount
+        result['force'] = bool(forced)
+        result['status'] = status
+        result['gamesFetched'] = gamesFetched
+        result['rowsWritten'] = rowsWritten
+        result['elapsed'] = round((finishedAt or time.time()) - startedAt, 3) if startedAt else 0
+        result['error'] = error
+
+    return result
+
+# Update jobs run one by one in a background thread of the process, and one at a time across
+# the processes (UPDATE_LOCK).
+# target(conn, count, force, progress) does the work; progress(games, rows) reports its advance.
+# Job state is kept in the database, so any process (or replica) can report it.
+class UpdateJobs:
+    def __init__(self, connection, target):
+        self.connection = connection
+        self.target = target
+        self.queue = queue.Queue()
+        self.worker = None
+        self.lock = threading.Lock()
+        # Jobs of this process, which wait in the queue, and the one running
+        self.queued = set()
+        self.running = None
+
+    # Queue an update job; returns id of the new job or of an identical job, which is already active
+    def submit(self, conn, count, force=False):
+        cur = conn.cursor()
+        cur.execute('SELECT GET_LOCK(?, ?)', ('nhltop_jobs', JOB_LOCK_TIMEOUT))
+        (locked,) = cur.fetchone()
+        if not locked:
+            raise JobLockTimeout()
+
+        try:
+            jobId = db_find_active_job(conn, count, force)
+            if jobId is not None:
+                return jobId
+            jobId = db_create_job(conn, count, force)
+        finally:
+            cur.execute('SELECT RELEASE_LOCK(?)', ('nhltop_jobs',))
+            cur.fetchone()
+
+        with self.lock:
+            self.queued.add(jobId)
+        self.queue.put((jobId, count, force))
+        self.start()
+
+        return jobId
+
+    def start(self):
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.work, name='update-jobs', daemon=True)
+                self.worker.start()
+
+    def work(self):
+        while True:
+            (jobId, count, force) = self.queue.get()
+            try:
+                self.run(jobId, count, force)
+            except Exception as err:
+                print(f'Update job {jobId} failed: {err}')
+            finally:
+                self.queue.task_done()
+
+    def touch_queued(self, conn):
+        with self.lock:
+            jobIds = list(self.queued)
+        db_touch_queued_jobs(conn, jobIds)
+
+    # Wait for the jobs of other processes; queued jobs of this one are kept alive meanwhile
+    def acquire_update_lock(self, conn):
+        cur = conn.cursor()
+        while True:
+            cur.execute('SELECT GET_LOCK(?, ?)', (UPDATE_LOCK, JOB_WAIT_INTERVAL))
+            (locked,) = cur.fetchone()
+            if locked:
+                return
+            self.touch_queued(conn)
+
+    def release_update_lock(self, conn):
+        cur = conn.cursor()
+        cur.execute('SELECT RELEASE_LOCK(?)', (UPDATE_LOCK,))
+        cur.fetchone()
+
+    def run(self, jobId, count, force):
+        try:
+            with self.connection() as conn:
+                self.acquire_update_lock(conn)
+                try:
+                    self.run_locked(conn, jobId, count, force)
+                finally:
+                    self.release_update_lock(conn)
+        finally:
+            with self.lock:
+                self.queued.discard(jobId)
+                self.running = None
+
+    # Mark the jobs of this process failed, as it is exiting (the worker thread dies with it)
+    def abandon(self, reason):
+        with self.lock:
+            jobIds = list(self.queued) + ([self.running] if self.running else [])
+        if not jobIds:
+            return
+
+        print(f"Update jobs {', '.join(jobIds)} abandoned: {reason}")
+        with self.connection() as conn:
+            db_fail_jobs(conn, jobIds, reason)
+
+    def run_locked(self, conn, jobId, count, force):
+        with self.lock:
+            self.queued.discard(jobId)
+            self.running = jobId
+        db_update_job(conn, jobId, status='running', startedAt=time.time())
+        totals = {'gamesFetched': 0, 'rowsWritten': 0}
+
+        def progress(games, rows):
+            totals['gamesFetched'] += games
+            totals['rowsWritten'] += rows
+            db_update_job(conn, jobId, **totals)
+            self.touch_queued(conn)
+
+        try:
+            self.target(conn, count, force, progress)
+        except Exception as err:
+            conn.rollback()
+            db_update_job(conn, jobId, status='failed', finishedAt=time.time(), error=str(err)[:255])
+            raise
+
+        db_update_job(conn, jobId, status='done', finishedAt=time.time())
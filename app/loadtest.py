@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import tempfile
+import sqlite3
+import random
+import json
+import time
+import sys
+import re
+import os
+
+# Load test of the web routes: concurrent clients request '/', '/stats' and '/check/' in the
+# given mix for a while, and latency percentiles and throughput are reported per route.
+# By default the Flask app runs in this process on a SQLite database seeded from the fake
+# NHL API; with --url a running server (e.g. a pod) is tested instead.
+#
+#   loadtest.py [--url http://host:5000] [--duration 10] [--concurrency 8]
+#               [--mix main=3,stats=6,check=1] [--dist uniform,zipf] [--miss 0.1]
+#               [--save baseline.json] [--compare baseline.json [--tolerance 0.25]]
+
+# Route results compared with a baseline: key and whether bigger is better
+COMPARED = [('requests_per_sec', True), ('p50_ms', False), ('p95_ms', False), ('p99_ms', False)]
+
+# Links to the statistics pages on the main page
+STATS_LINK = re.compile(r'/stats\?gamePk=(\d+)&(?:amp;)?personId=(\d+)')
+
+# sqlite3 connection with the bits of the MariaDB connection API, which the connection pool uses
+class SQLiteConnection:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+    def ping(self):
+        self.conn.execute('SELECT 1')
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+# Store the last seasons from the fake NHL API into a fresh SQLite database
+def seed_database(path, count):
+    import benchmark
+    import fakeapi
+    import nhltop
+
+    api = fakeapi.FakeNHLAPI().start()
+    nhltop.API_URL = api.url
+    nhltop.http_cache = None
+    try:
+        conn = benchmark.sqlite_connect(path)
+        nhltop.update_seasons(conn, nhltop.get_last_seasons(count))
+        conn.close()
+    finally:
+        api.stop()
+
+# Flask app of this process using the seeded database; cold disables the page and statistics caches
+def local_client(path, cold):
+    import app as webapp
+    import dbstats
+
+    webapp.db_pool.connect = lambda: dbstats.InstrumentedConnection(SQLiteConnection(path))
+    if cold:
+        webapp.page_cache.ttl = 0
+        webapp.stats_cache.maxsize = 0
+
+    def get(route):
+        with webapp.app.test_client() as client:
+            response = client.get(route)
+            return (response.status_code, response.get_data(as_text=True))
+
+    return get
+
+def remote_client(url):
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=64)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    def get(route):
+        response = session.get(url.rstrip('/') + route)
+        return (response.status_code, response.text)
+
+    return get
+
+# Picks statistics page keys: uniformly or by Zipf's law (few hot players), with a share of
+# unknown players, which are never cached by the app
+def key_picker(keys, dist, miss, seed=0):
+    keys = list(keys)
+    random.Random(seed).shuffle(keys)
+
+    if dist == 'zipf':
+        weights = [1 / rank ** 1.1 for rank in range(1, len(keys) + 1)]
+    else:
+        weights = [1] * len(keys)
+
+    def pick(rnd):
+        if rnd.random() < miss:
+            (gamePk, personId) = rnd.choice(keys)
+            return (gamePk, personId + 10000000)
+        return rnd.choices(keys, weights)[0]
+
+    return pick
+
+# Latency percentile in milliseconds (nearest rank)
+def percentile(latencies, share):
+    if not latencies:
+        return 0
+    index = min(len(latencies) - 1, max(0, round(share * len(latencies)) - 1))
+    return round(latencies[index] * 1000, 2)
+
+# Clients send requests until the deadline; returns {route name: [(seconds, status), ...]}
+def run_load(get, mix, pick, duration, concurrency):
+    routes = list(mix)
+    weights = [mix[route] for route in routes]
+    deadline = time.monotonic() + duration
+
+    def client(seed):
+        rnd = random.Random(seed)
+        samples = {route: [] for route in routes}
+
+        while time.monotonic() < deadline:
+            route = rnd.choices(routes, weights)[0]
+            if route == 'main':
+                path = '/'
+            elif route == 'check':
+                path = '/check/'
+            else:
+                (gamePk, personId) = pick(rnd)
+                path = f'/stats?gamePk={gamePk}&personId={personId}'
+
+            start = time.perf_counter()
+            try:
+                (status, body) = get(path)
+            except Exception:
+                status = 0
+            samples[route].append((time.perf_counter() - start, status))
+
+        return samples
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        clients = list(executor.map(client, range(concurrency)))
+
+    return {route: [sample for samples in clients for sample in samples[route]] for route in routes}
+
+def route_results(dist, samples, duration):
+    results = []
+
+    for (route, route_samples) in samples.items():
+        latencies = sorted(seconds for (seconds, status) in route_samples)
+
+        result = {}
+        result['scenario'] = f'{dist} {route}'
+        result['requests'] = len(route_samples)
+        result['errors'] = len([status for (seconds, status) in route_samples if status != 200])
+        result['requests_per_sec'] = round(len(route_samples) / duration, 1)
+        result['p50_ms'] = percentile(latencies, 0.50)
+        result['p95_ms'] = percentile(latencies, 0.95)
+        result['p99_ms'] = percentile(latencies, 0.99)
+        results.append(result)
+
+    return results
+
+def print_results(results):
+    print(f"{'scenario':<16} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for r in results:
+        print(f"{r['scenario']:<16} {r['requests']:>9} {r['errors']:>7} {r['requests_per_sec']:>9.1f} "
+              f"{r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the web routes')
+    parser.add_argument('--url', help='base URL of a running server (default: the app in this process)')
+    parser.add_argument('--seasons', type=int, default=15, help='seasons seeded into the local database')
+    parser.add_argument('--cold', action='store_true', help='disable the page and statistics caches (local app)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per key distribution')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--mix', default='main=3,stats=6,check=1', help='route weights')
+    parser.add_argument('--dist', default='uniform,zipf', help='key distributions of the statistics pages')
+    parser.add_argument('--miss', type=float, default=0.1, help='share of statistics requests for unknown players')
+    parser.add_argument('--save', help='write the results to this file (JSON)')
+    parser.add_argument('--compare', help='baseline results file; exit with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed regression (share)')
+    args = parser.parse_args()
+
+    mix = {}
+    for item in args.mix.split(','):
+        (route, weight) = item.split('=')
+        mix[route] = float(weight)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.url:
+            get = remote_client(args.url)
+        else:
+            path = os.path.join(tmp_dir, 'nhltop.db')
+            seed_database(path, args.seasons)
+            get = local_client(path, args.cold)
+
+        # Statistics pages of the top players, as linked from the main page
+        keys = set()
+        for (gamePk, personId) in STATS_LINK.findall(get('/')[1]):
+            keys.add((int(gamePk), int(personId)))
+        if not keys and 'stats' in mix:
+            print('No players on the main page, is the database empty?', file=sys.stderr)
+            return 2
+
+        results = []
+        for dist in args.dist.split(','):
+            pick = key_picker(sorted(keys), dist, args.miss)
+            samples = run_load(get, mix, pick, args.duration, args.concurrency)
+            results += route_results(dist, samples, args.duration)
+
+    print_results(results)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'target': args.url or f'local ({args.seasons} seasons{", cold" if args.cold else ""})',
+        'concurrency': args.concurrency,
+        'mix': args.mix,
+        'miss': args.miss,
+        'results': results
+    }
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        import benchmark
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = benchmark.compare(results, json.load(f), args.tolerance, 'scenario', COMPARED)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}')
+        if regressions:
+            return 1
+        print('No regressions')
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
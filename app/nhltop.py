@@ -1,36 +1,310 @@
 #!/usr/bin/env python
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
+from requests.packages.urllib3.connection import HTTPConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.packages.urllib3.exceptions import HTTPError as Urllib3Error
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from contextlib import contextmanager
 import requests
+import threading
+import tempfile
+import socket
+import shutil
+import time
 import sys
 import os
 import mariadb
+import ijson
+import httpcache
+
+# NHL API base url
+API_URL = os.environ.get('NHL_API_URL', 'https://statsapi.web.nhl.com/api/v1/')
+
+# Number of boxscores fetched from the API at once
+FETCH_WORKERS = int(os.environ.get('NHL_FETCH_WORKERS', 8))
+
+# On-disk cache of API replies (disabled unless NHL_CACHE_DIR is set) and lifetime
+# of the replies, which may change (list of seasons, schedule of the current season)
+HTTP_CACHE_DIR = os.environ.get('NHL_CACHE_DIR')
+HTTP_CACHE_TTL = int(os.environ.get('NHL_CACHE_TTL', 6 * 3600))
+
+http_cache = httpcache.HTTPCache(HTTP_CACHE_DIR) if HTTP_CACHE_DIR else None
+
+# Shared HTTP client settings (number of host pools, connections per host, TCP keep-alive)
+HTTP_POOL_CONNECTIONS = int(os.environ.get('NHL_HTTP_POOL_CONNECTIONS', 4))
+HTTP_POOL_MAXSIZE = int(os.environ.get('NHL_HTTP_POOL_MAXSIZE', 10))
+HTTP_KEEPALIVE = os.environ.get('NHL_HTTP_KEEPALIVE', '1') == '1'
+
+# Counters of HTTP requests sent and TCP connections opened by the shared session
+http_stats = {'requests': 0, 'connections': 0}
+http_stats_lock = threading.Lock()
+
+http_session = None
+http_session_lock = threading.Lock()
+
+def http_stats_inc(key):
+    with http_stats_lock:
+        http_stats[key] += 1
+
+# Connection pools, which count new connections and requests made over them
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        http_stats_inc('connections')
+        return super()._new_conn()
+
+    def _make_request(self, *args, **kwargs):
+        http_stats_inc('requests')
+        return super()._make_request(*args, **kwargs)
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        http_stats_inc('connections')
+        return super()._new_conn()
+
+    def _make_request(self, *args, **kwargs):
+        http_stats_inc('requests')
+        return super()._make_request(*args, **kwargs)
+
+# Retry policy, which reports every retry as the 'api_retries' counter (by status or 'error')
+class CountingRetry(Retry):
+    def increment(self, *args, **kwargs):
+        response = kwargs.get('response')
+        record_stage('count', 'api_retries', 1, str(response.status) if response is not None else 'error')
+        return super().increment(*args, **kwargs)
+
+class PooledHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        if HTTP_KEEPALIVE:
+            kwargs['socket_options'] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            ]
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool
+        }
+
+# Returns the module-wide HTTP session (created on first use)
+def get_http_session():
+    global http_session
+
+    with http_session_lock:
+        if http_session is None:
+            retry_strategy = CountingRetry(
+                total=10,
+                status_forcelist=[429, 500, 502, 503, 504],
+                backoff_factor = 0.1
+            )
+            adapter = PooledHTTPAdapter(
+                pool_connections=HTTP_POOL_CONNECTIONS,
+                pool_maxsize=HTTP_POOL_MAXSIZE,
+                pool_block=True,
+                max_retries=retry_strategy
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            http_session = session
+
+    return http_session
+
+# Returns HTTP counters; 'reused' is the number of requests sent over already open connections
+def get_http_stats():
+    with http_stats_lock:
+        result = dict(http_stats)
+    result['reused'] = result['requests'] - result['connections']
+
+    return result
+
+# Timings of the update stages ('span', seconds) and counters ('count', amount), by name and label.
+# They are summed up here for the CLI and passed to observers, e.g. to the Prometheus metrics
+# of the web app: observer(kind, name, label, value).
+stage_stats = {}
+stage_stats_lock = threading.Lock()
+stage_observers = []
+
+def add_stage_observer(observer):
+    stage_observers.append(observer)
+
+def record_stage(kind, name, value, label=''):
+    with stage_stats_lock:
+        entry = stage_stats.setdefault((kind, name, label), [0, 0])
+        entry[0] += 1
+        entry[1] += value
+
+    for observer in stage_observers:
+        observer(kind, name, label, value)
+
+# Timing span of a stage: 'with stage_span(name):' or as a function decorator
+@contextmanager
+def stage_span(name, label=''):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record_stage('span', name, time.monotonic() - start, label)
+
+# Returns {(kind, name, label): (count, total)}, spans first, sorted by name
+def get_stage_stats():
+    with stage_stats_lock:
+        keys = sorted(stage_stats, key=lambda key: (key[0] != 'span', key))
+        return {key: tuple(stage_stats[key]) for key in keys}
+
+def reset_stage_stats():
+    with stage_stats_lock:
+        stage_stats.clear()
+
+# Stage timings and counters as text lines
+def format_stage_stats():
+    lines = []
+    for ((kind, name, label), (count, total)) in get_stage_stats().items():
+        title = f'{name} {label}' if label else name
+        if kind == 'span':
+            lines.append(f'{title:<36} {count:>7} x {total:>9.3f} s (avg {total * 1000 / count:.1f} ms)')
+        else:
+            lines.append(f'{title:<36} {total:>7}')
 
-# Wrap requests.get function to survive long site reply delays
-def get_with_retries(url):
+    return lines
+
+# API endpoint of the URL for metrics, e.g. 'game/{id}/boxscore' or 'schedule'
+def api_endpoint(url):
+    path = url[len(API_URL):] if url.startswith(API_URL) else url
+    path = path.split('?')[0]
+
+    return '/'.join('{id}' if part.isdigit() else part for part in path.split('/'))
+
+# Conditional GET headers to revalidate an expired cache entry
+def revalidation_headers(entry):
+    headers = {}
+    if entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry['lastModified']:
+        headers['If-Modified-Since'] = entry['lastModified']
+
+    return headers
+
+# Wrap requests.get function to survive long site reply delays.
+# Replies are cached on disk for ttl seconds (httpcache.IMMUTABLE - forever, 0 - not cached);
+# expired entries are revalidated with a conditional GET and used as is if the API is unreachable.
+def get_with_retries(url, ttl=0):
     # timeout in seconds
     timeout = 5
 
-    retry_strategy = Retry(
-        total=10,
-        status_forcelist=[429, 500, 502, 503, 504],
-        backoff_factor = 0.1
-    )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    http = requests.Session()
-    http.mount("https://", adapter)
+    caching = http_cache is not None and ttl != 0
+    entry = None
+    headers = {}
+    if caching:
+        entry = http_cache.load(url)
+        if entry is not None:
+            if http_cache.is_fresh(entry):
+                return http_cache.read_body(entry)
+            headers = revalidation_headers(entry)
+
+    http = get_http_session()
 
     try:
-        reply = http.get(url, timeout=timeout)
-        reply.raise_for_status()
-        return reply.json()
+        with stage_span('api_request', api_endpoint(url)):
+            reply = http.get(url, timeout=timeout, headers=headers)
+            if reply.status_code == 304 and entry is not None:
+                return http_cache.read_body(http_cache.touch(entry, ttl))
+            reply.raise_for_status()
+            body = reply.json()
     except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as err:
-        return {}
+        return http_cache.read_body(entry) if entry is not None else {}
     except requests.exceptions.RequestException as err:
         print(f'{err}')
         return {}
 
+    if caching:
+        http_cache.store(url, reply.content, ttl, reply.headers.get('ETag'), reply.headers.get('Last-Modified'))
+
+    return body
+
+# Replies of stream_with_retries are kept in memory up to that size, bigger ones go to a temporary file
+STREAM_SPOOL_SIZE = int(os.environ.get('NHL_STREAM_SPOOL_SIZE', 1024 * 1024))
+
+# Same as get_with_retries, but yields the items found by ijson prefix (e.g. 'dates.item') of the reply,
+# so the whole reply is never parsed at once. The reply is received into a spool file first and checked
+# to be complete JSON: a reply cut by the network gives nothing (or the cached entry), not a part of the items.
+def stream_with_retries(url, prefix, ttl=0):
+    # timeout in seconds
+    timeout = 5
+
+    caching = http_cache is not None and ttl != 0
+    entry = None
+    headers = {}
+    if caching:
+        entry = http_cache.load(url)
+        if entry is not None and http_cache.is_fresh(entry):
+            yield from stream_cached(entry, prefix)
+            return
+        if entry is not None:
+            headers = revalidation_headers(entry)
+
+    http = get_http_session()
+
+    reply = None
+    revalidated = False
+    spool = tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_SIZE)
+    try:
+        start = time.monotonic()
+        try:
+            reply = http.get(url, timeout=timeout, headers=headers, stream=True)
+            if reply.status_code == 304 and entry is not None:
+                entry = http_cache.touch(entry, ttl)
+                revalidated = True
+            else:
+                reply.raise_for_status()
+                reply.raw.decode_content = True
+                shutil.copyfileobj(reply.raw, spool)
+
+                # The whole reply must parse before it is cached or its items are yielded
+                spool.seek(0)
+                for _ in ijson.parse(spool):
+                    pass
+                spool.seek(0)
+            record_stage('span', 'api_request', time.monotonic() - start, api_endpoint(url))
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError,
+                Urllib3Error, ijson.JSONError) as err:
+            # Reply body could be cut or malformed as well: use the cached entry if there is one
+            if entry is None:
+                return
+            revalidated = True
+        except requests.exceptions.RequestException as err:
+            print(f'{err}')
+            return
+        finally:
+            if reply is not None:
+                reply.close()
+
+        if revalidated:
+            yield from stream_cached(entry, prefix)
+            return
+
+        if caching:
+            http_cache.store(url, spool, ttl, reply.headers.get('ETag'), reply.headers.get('Last-Modified'))
+            spool.seek(0)
+
+        yield from ijson.items(spool, prefix, use_float=True)
+    finally:
+        spool.close()
+
+def stream_cached(entry, prefix):
+    with http_cache.open_body(entry) as f:
+        yield from ijson.items(f, prefix, use_float=True)
+
+# Returns id of the current NHL season ('' if the API is not available)
+def get_current_season():
+    reply = get_with_retries(API_URL + 'seasons/current', ttl=HTTP_CACHE_TTL)
+    if reply == {}:
+        return ''
+
+    return reply['seasons'][0]['seasonId']
+
 # Get last N finished NHL seasons (no more than 15)
+@stage_span('get_last_seasons')
 def get_last_seasons(count):
     result = []
 
@@ -38,15 +312,13 @@ def get_last_seasons(count):
     if count < 1: count = 1
     if count > 15: count = 15
 
-    baseurl = 'https://statsapi.web.nhl.com/api/v1/seasons/'
+    baseurl = API_URL + 'seasons/'
 
-    reply = get_with_retries(baseurl + 'current')
-    if reply == {}:
+    current_season = get_current_season()
+    if current_season == '':
         return []
 
-    current_season = reply['seasons'][0]['seasonId']
-
-    reply = get_with_retries(baseurl)
+    reply = get_with_retries(baseurl, ttl=HTTP_CACHE_TTL)
     if reply == {}:
         return []
 
@@ -59,28 +331,134 @@ def get_last_seasons(count):
 
     return result
 
+# Yields season games of particular type (A or P) while the schedule is being parsed.
+# final_only skips all the games except the Final series ones.
+def iter_season_games(season, type, final_only=False):
+    baseurl = API_URL + 'schedule?'
+
+    # Schedule of a finished season doesn't change
+    ttl = 0
+    if http_cache is not None:
+        current_season = get_current_season()
+        if current_season != '' and season < current_season:
+            ttl = httpcache.IMMUTABLE
+        else:
+            ttl = HTTP_CACHE_TTL
+
+    for date in stream_with_retries(baseurl + 'season=' + season + '&gameType=' + type, 'dates.item', ttl=ttl):
+        for game in date['games']:
+            if final_only and str(game['gamePk'])[7] != '4':
+                continue
+            game['gameDate'] = date['date']  # replace gameDate with correct date (start of the game)
+            yield game
+
 # returns list of season games of particular type (A or P)
 def get_season_games(season, type):
-    result = []
-    baseurl = 'https://statsapi.web.nhl.com/api/v1/schedule?'
-
-    reply = get_with_retries(baseurl + 'season=' + season + '&gameType=' + type)
-    if reply == {}:
-        return []
+    return list(iter_season_games(season, type))
+
+# Compact records of a player in a game, which replace boxscore dicts in the ingest path.
+# PlayerGame holds the persons and roster columns (see person_row and roster_row);
+# the stats lines follow the columns of the skaterStats and goalieStats tables,
+# so they are used as rows of executemany directly.
+PlayerGame = namedtuple('PlayerGame', [
+    'gamePk', 'personId', 'fullName', 'birthDate', 'birthCity', 'birthCountry', 'nationality',
+    'jerseyNumber', 'positionName', 'teamName', 'teamId', 'stats'
+])
+
+SkaterLine = namedtuple('SkaterLine', [
+    'gamePk', 'personId', 'timeOnIceSec', 'assists', 'goals', 'shots', 'hits',
+    'powerPlayGoals', 'powerPlayAssists', 'penaltyMinutes', 'faceOffWins', 'faceoffTaken',
+    'takeaways', 'giveaways', 'shortHandedGoals', 'shortHandedAssists', 'blocked', 'plusMinus',
+    'evenTimeOnIceSec', 'powerPlayTimeOnIceSec', 'shortHandedTimeOnIceSec'
+])
+
+GoalieLine = namedtuple('GoalieLine', [
+    'gamePk', 'personId', 'timeOnIceSec', 'assists', 'goals', 'pim', 'shots', 'saves',
+    'powerPlaySaves', 'shortHandedSaves', 'evenSaves', 'shortHandedShotsAgainst',
+    'evenShotsAgainst', 'powerPlayShotsAgainst', 'savePercentage'
+])
+
+# Time on ice as integer seconds ('MM:SS' in the API, minutes may exceed 59)
+def toi_seconds(toi):
+    if not toi:
+        return 0
+    (minutes, _, seconds) = toi.partition(':')
+
+    return int(minutes) * 60 + int(seconds or 0)
+
+# Convert boxscore player to PlayerGame record (missing stats keys are set to 0,
+# time on ice is converted to seconds)
+def player_record(game_id, player, team):
+    person = player['person']
 
-    for date in reply['dates']:
-      for game in date['games']:
-        game['gameDate'] = date['date']  # replace gameDate with correct date (start of the game)
-        result.append(game)
+    if player['position']['name'] == 'Goalie':
+        stats = player['stats']['goalieStats']
+        line = GoalieLine(
+            game_id,
+            person['id'],
+            toi_seconds(stats['timeOnIce']),
+            stats['assists'],
+            stats['goals'],
+            stats['pim'],
+            stats['shots'],
+            stats['saves'],
+            stats['powerPlaySaves'],
+            stats['shortHandedSaves'],
+            stats['evenSaves'],
+            stats['shortHandedShotsAgainst'],
+            stats['evenShotsAgainst'],
+            stats['powerPlayShotsAgainst'],
+            stats.get('savePercentage', 0)
+        )
+    else:
+        stats = player['stats']['skaterStats']
+        line = SkaterLine(
+            game_id,
+            person['id'],
+            toi_seconds(stats['timeOnIce']),
+            stats['assists'],
+            stats['goals'],
+            stats['shots'],
+            stats.get('hits', 0),
+            stats['powerPlayGoals'],
+            stats['powerPlayAssists'],
+            stats['penaltyMinutes'],
+            stats['faceOffWins'],
+            stats['faceoffTaken'],
+            stats.get('takeaways', 0),
+            stats.get('giveaways', 0),
+            stats['shortHandedGoals'],
+            stats['shortHandedAssists'],
+            stats.get('blocked', 0),
+            stats['plusMinus'],
+            toi_seconds(stats['evenTimeOnIce']),
+            toi_seconds(stats['powerPlayTimeOnIce']),
+            toi_seconds(stats['shortHandedTimeOnIce'])
+        )
 
-    return result
+    return PlayerGame(
+        game_id,
+        person['id'],
+        person['fullName'],
+        person['birthDate'],
+        person['birthCity'],
+        person['birthCountry'],
+        person['nationality'],
+        player['jerseyNumber'],
+        player['position']['name'],
+        team['name'],
+        team['id'],
+        line
+    )
 
-# returns list of players which took part in the game
-def get_game_players(game_id):
+# returns list of players (PlayerGame records) which took part in the game
+# (boxscores of finished games are cached)
+def get_game_players(game_id, final=False):
     result = []
-    baseurl = 'https://statsapi.web.nhl.com/api/v1/game/'
+    baseurl = API_URL + 'game/'
 
-    reply = get_with_retries(baseurl + str(game_id) + '/boxscore')
+    ttl = httpcache.IMMUTABLE if final else 0
+    reply = get_with_retries(baseurl + str(game_id) + '/boxscore', ttl=ttl)
     if reply == {}:
         return []
     
@@ -92,17 +470,34 @@ def get_game_players(game_id):
     for key in players_away.keys():
         player = players_away[key]
         if player['stats']: 
-            player['team'] = team_away
-            result.append(player)
+            result.append(player_record(game_id, player, team_away))
 
     for key in players_home.keys():
         player = players_home[key]
         if player['stats']: 
-            player['team'] = team_home
-            result.append(player)
+            result.append(player_record(game_id, player, team_home))
 
     return result
 
+# True if the schedule game is finished
+def is_game_final(game):
+    return game.get('status', {}).get('abstractGameState') == 'Final'
+
+# Fetch players of several games in parallel (no more than 'workers' at once).
+# Results are returned in the same order as the games list.
+def get_games_players(games, workers=None):
+    if workers is None:
+        workers = FETCH_WORKERS
+
+    def fetch(game):
+        return get_game_players(game['gamePk'], final=is_game_final(game))
+
+    if workers < 2 or len(games) < 2:
+        return [fetch(game) for game in games]
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(games))) as executor:
+        return list(executor.map(fetch, games))
+
 # Database connect (errors are handled in calling functions)
 def db_connect():
     username = os.environ.get('DB_USER')
@@ -117,354 +512,911 @@ def db_connect():
         database = database
     )
 
-# Update DB schema if needed (for now just recreate all the tables)
-def db_update_schema(conn):
-    required_version = 1
+# Schema migrations as (version, statements) pairs in ascending order.
+# Every step is applied once; its version is recorded in schema_ver afterwards.
+# Steps of the schema upgrade: (version, statements). MariaDB commits after every DDL statement,
+# so a step interrupted in the middle is run again from its first statement, and every statement
+# must be safe to repeat. Statements, which aren't, are given as (requirements, statement) and run
+# only if all the space separated requirements hold: 'table' or 'table.column' exists, '!table.column' doesn't.
+SCHEMA_MIGRATIONS = [
+    (1, [
+        """
+        CREATE TABLE IF NOT EXISTS games (
+          gamePk INT UNSIGNED NOT NULL PRIMARY KEY,
+          season INT UNSIGNED,
+          gameType CHAR,
+          gameDate DATE,
+          team_away_id SMALLINT UNSIGNED,
+          team_away_name NVARCHAR(255),
+          team_away_score TINYINT UNSIGNED,
+          team_home_id SMALLINT UNSIGNED,
+          team_home_name NVARCHAR(255),
+          team_home_score TINYINT UNSIGNED
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS players (
+          gamePk INT UNSIGNED NOT NULL,
+          personId INT UNSIGNED NOT NULL,
+          fullName NVARCHAR(255),
+          birthDate DATE,
+          birthCity NVARCHAR(50),
+          birthCountry NVARCHAR(10),
+          nationality NVARCHAR(10),
+          jerseyNumber TINYINT UNSIGNED,
+          positionName NVARCHAR(30),
+          teamName NVARCHAR(50),
+          teamId SMALLINT UNSIGNED,
+          PRIMARY KEY(gamePk, personId),
+          CONSTRAINT `fk_gamePk`
+             FOREIGN KEY (gamePk) REFERENCES games (gamePk)
+             ON DELETE CASCADE
+             ON UPDATE CASCADE
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS goalieStats (
+          gamePk INT UNSIGNED NOT NULL,
+          personId INT UNSIGNED NOT NULL,
+          timeOnIce NVARCHAR(10),
+          assists SMALLINT,
+          goals SMALLINT,
+          pim SMALLINT,
+          shots SMALLINT,
+          saves SMALLINT,
+          powerPlaySaves SMALLINT,
+          shortHandedSaves SMALLINT,
+          evenSaves SMALLINT,
+          shortHandedShotsAgainst SMALLINT,
+          evenShotsAgainst SMALLINT,
+          powerPlayShotsAgainst SMALLINT,
+          savePercentage DECIMAL(17,14),
+          PRIMARY KEY(gamePk, personId),
+          CONSTRAINT `fk_game_person_g`
+             FOREIGN KEY (gamePk, personId) REFERENCES players (gamePk, personId)
+             ON DELETE CASCADE
+             ON UPDATE CASCADE
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS skaterStats (
+          gamePk INT UNSIGNED NOT NULL,
+          personId INT UNSIGNED NOT NULL,
+          timeOnIce NVARCHAR(10),
+          assists SMALLINT,
+          goals SMALLINT,
+          shots SMALLINT,
+          hits SMALLINT,
+          powerPlayGoals SMALLINT,
+          powerPlayAssists SMALLINT,
+          penaltyMinutes SMALLINT,
+          faceOffWins SMALLINT,
+          faceoffTaken SMALLINT,
+          takeaways SMALLINT,
+          giveaways SMALLINT,
+          shortHandedGoals SMALLINT,
+          shortHandedAssists SMALLINT,
+          blocked SMALLINT,
+          plusMinus SMALLINT,
+          evenTimeOnIce NVARCHAR(10),
+          powerPlayTimeOnIce NVARCHAR(10),
+          shortHandedTimeOnIce NVARCHAR(10),
+          PRIMARY KEY(gamePk, personId),
+          CONSTRAINT `fk_game_person_s`
+             FOREIGN KEY (gamePk, personId) REFERENCES players (gamePk, personId)
+             ON DELETE CASCADE
+             ON UPDATE CASCADE
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS schema_ver (
+          version SMALLINT UNSIGNED NOT NULL PRIMARY KEY
+        )"""
+    ]),
+    # Secondary indexes for season and game type filters and for lookups by player
+    (2, [
+        'CREATE INDEX IF NOT EXISTS idx_games_season ON games (season, gameType)',
+        'CREATE INDEX IF NOT EXISTS idx_games_type ON games (gameType, season)',
+        'CREATE INDEX IF NOT EXISTS idx_players_person ON players (personId, gamePk)'
+    ]),
+    # State of the game (Final, Live, Preview) for incremental updates
+    (3, [
+        ('!games.gameState', 'ALTER TABLE games ADD COLUMN gameState NVARCHAR(20)')
+    ]),
+    # Background update jobs and their progress
+    (4, [
+        """
+        CREATE TABLE IF NOT EXISTS update_jobs (
+          jobId CHAR(32) NOT NULL PRIMARY KEY,
+          seasonCount INT UNSIGNED,
+          forced TINYINT UNSIGNED,
+          status NVARCHAR(10),
+          gamesFetched INT UNSIGNED,
+          rowsWritten INT UNSIGNED,
+          createdAt DOUBLE,
+          startedAt DOUBLE,
+          updatedAt DOUBLE,
+          finishedAt DOUBLE,
+          error NVARCHAR(255)
+        )""",
+        'CREATE INDEX IF NOT EXISTS idx_update_jobs_status ON update_jobs (status, seasonCount, forced)'
+    ]),
+    # Materialized top players of the seasons (refreshed by update_seasons), filled from the stored games
+    (5, [
+        """
+        CREATE TABLE IF NOT EXISTS season_top_players (
+          season INT UNSIGNED NOT NULL,
+          personId INT UNSIGNED NOT NULL,
+          fullName NVARCHAR(255),
+          gamePk INT UNSIGNED NOT NULL,
+          PRIMARY KEY(season, personId)
+        )""",
+        'CREATE INDEX IF NOT EXISTS idx_season_top_players_name ON season_top_players (season, fullName, personId, gamePk)',
+        """
+        INSERT INTO season_top_players (season, personId, fullName, gamePk)
+        SELECT f.season, f.personId, f.fullName, f.gamePk
+        FROM (SELECT p.personId, p.fullName, p.gamePk, g.season,
+                     ROW_NUMBER() OVER (PARTITION BY g.season, p.personId ORDER BY p.gamePk DESC) AS rn
+              FROM players p INNER JOIN games g ON p.gamePk = g.gamePk
+              WHERE g.gameType = 'P') f
+             INNER JOIN
+             (SELECT DISTINCT p.personId, g.season
+              FROM players p INNER JOIN games g ON p.gamePk = g.gamePk
+              WHERE g.gameType = 'A') a
+             ON f.personId = a.personId AND f.season = a.season
+        WHERE f.rn = 1"""
+    ]),
+    # Biography of a player is kept once in persons (the latest one seen), roster keeps
+    # the per-game details. Statistics tables are recreated to reference roster instead of players.
+    (6, [
+        """
+        CREATE TABLE IF NOT EXISTS persons (
+          personId INT UNSIGNED NOT NULL PRIMARY KEY,
+          fullName NVARCHAR(255),
+          birthDate DATE,
+          birthCity NVARCHAR(50),
+          birthCountry NVARCHAR(10),
+          nationality NVARCHAR(10)
+        )""",
+        """
+        CREATE TABLE IF NOT EXISTS roster (
+          gamePk INT UNSIGNED NOT NULL,
+          personId INT UNSIGNED NOT NULL,
+          jerseyNumber TINYINT UNSIGNED,
+          positionName NVARCHAR(30),
+          teamName NVARCHAR(50),
+          teamId SMALLINT UNSIGNED,
+          PRIMARY KEY(gamePk, personId),
+          CONSTRAINT `fk_roster_game`
+             FOREIGN KEY (gamePk) REFERENCES games (gamePk)
+             ON DELETE CASCADE
+             ON UPDATE CASCADE,
+          CONSTRAINT `fk_roster_person`
+             FOREIGN KEY (personId) REFERENCES persons (personId)
+        )""",
+        ('players', """
+        INSERT INTO persons (personId, fullName, birthDate, birthCity, birthCountry, nationality)
+        SELECT p.personId, p.fullName, p.birthDate, p.birthCity, p.birthCountry, p.nationality
+        FROM players p
+        WHERE p.gamePk = (SELECT MAX(l.gamePk) FROM players l WHERE l.personId = p.personId)
+          AND NOT EXISTS (SELECT 1 FROM persons x WHERE x.personId = p.personId)"""),
+        ('players', """
+        INSERT INTO roster (gamePk, personId, jerseyNumber, positionName, teamName, teamId)
+        SELECT p.gamePk, p.personId, p.jerseyNumber, p.positionName, p.teamName, p.teamId
+        FROM players p
+        WHERE NOT EXISTS (SELECT 1 FROM roster r WHERE r.gamePk = p.gamePk AND r.personId = p.personId)"""),
+        'CREATE INDEX IF NOT EXISTS idx_roster_person ON roster (personId, gamePk)',
+        # Statistics are copied while players and the old tables exist (a copy of an interrupted run
+        # is made again), then the old tables go and the copies take their names
+        ('players goalieStats', 'DROP TABLE IF EXISTS goalieStats_v6'),
+        ('players goalieStats', """
+        CREATE TABLE goalieStats_v6 (
+          gamePk INT UNSIGNED NOT NULL,
+          personId INT UNSIGNED NOT NULL,
+          timeOnIce NVARCHAR(10),
+          assists SMALLINT,
+          goals SMALLINT,
+          pim SMALLINT,
+          shots SMALLINT,
+          saves SMALLINT,
+          powerPlaySaves SMALLINT,
+          shortHandedSaves SMALLINT,
+          evenSaves SMALLINT,
+          shortHandedShotsAgainst SMALLINT,
+          evenShotsAgainst SMALLINT,
+          powerPlayShotsAgainst SMALLINT,
+          savePercentage DECIMAL(17,14),
+          PRIMARY KEY(gamePk, personId),
+          CONSTRAINT `fk_roster_g`
+             FOREIGN KEY (gamePk, personId) REFERENCES roster (gamePk, personId)
+             ON DELETE CASCADE
+             ON UPDATE CASCADE
+        )"""),
+        ('players goalieStats', 'INSERT INTO goalieStats_v6 SELECT * FROM goalieStats'),
+        ('players', 'DROP TABLE IF EXISTS goalieStats'),
+        ('players skaterStats', 'DROP TABLE IF EXISTS skaterStats_v6'),
+        ('players skaterStats', """
+        CREATE TABLE skaterStats_v6 (
+          gamePk INT UNSIGNED NOT NULL,
+          personId INT UNSIGNED NOT NULL,
+          timeOnIce NVARCHAR(10),
+          assists SMALLINT,
+          goals SMALLINT,
+          shots SMALLINT,
+          hits SMALLINT,
+          powerPlayGoals SMALLINT,
+          powerPlayAssists SMALLINT,
+          penaltyMinutes SMALLINT,
+          faceOffWins SMALLINT,
+          faceoffTaken SMALLINT,
+          takeaways SMALLINT,
+          giveaways SMALLINT,
+          shortHandedGoals SMALLINT,
+          shortHandedAssists SMALLINT,
+          blocked SMALLINT,
+          plusMinus SMALLINT,
+          evenTimeOnIce NVARCHAR(10),
+          powerPlayTimeOnIce NVARCHAR(10),
+          shortHandedTimeOnIce NVARCHAR(10),
+          PRIMARY KEY(gamePk, personId),
+          CONSTRAINT `fk_roster_s`
+             FOREIGN KEY (gamePk, personId) REFERENCES roster (gamePk, personId)
+             ON DELETE CASCADE
+             ON UPDATE CASCADE
+        )"""),
+        ('players skaterStats', 'INSERT INTO skaterStats_v6 SELECT * FROM skaterStats'),
+        ('players', 'DROP TABLE IF EXISTS skaterStats'),
+        'DROP TABLE IF EXISTS players',
+        ('goalieStats_v6', 'ALTER TABLE goalieStats_v6 RENAME TO goalieStats'),
+        ('skaterStats_v6', 'ALTER TABLE skaterStats_v6 RENAME TO skaterStats')
+    ]),
+    # Time on ice as integer seconds instead of 'MM:SS' strings
+    (7, [
+        ('!goalieStats.timeOnIceSec', 'ALTER TABLE goalieStats ADD COLUMN timeOnIceSec SMALLINT UNSIGNED'),
+        ('goalieStats.timeOnIce', """
+        UPDATE goalieStats
+        SET timeOnIceSec = CAST(SUBSTR(timeOnIce, 1, INSTR(timeOnIce, ':') - 1) AS INTEGER) * 60
+                           + CAST(SUBSTR(timeOnIce, INSTR(timeOnIce, ':') + 1) AS INTEGER)"""),
+        ('goalieStats.timeOnIce', 'ALTER TABLE goalieStats DROP COLUMN timeOnIce'),
+        ('!skaterStats.timeOnIceSec', 'ALTER TABLE skaterStats ADD COLUMN timeOnIceSec SMALLINT UNSIGNED'),
+        ('!skaterStats.evenTimeOnIceSec', 'ALTER TABLE skaterStats ADD COLUMN evenTimeOnIceSec SMALLINT UNSIGNED'),
+        ('!skaterStats.powerPlayTimeOnIceSec',
+         'ALTER TABLE skaterStats ADD COLUMN powerPlayTimeOnIceSec SMALLINT UNSIGNED'),
+        ('!skaterStats.shortHandedTimeOnIceSec',
+         'ALTER TABLE skaterStats ADD COLUMN shortHandedTimeOnIceSec SMALLINT UNSIGNED'),
+        # The columns are converted together and dropped afterwards, the first one dropped tells if it's done
+        ('skaterStats.timeOnIce', """
+        UPDATE skaterStats
+        SET timeOnIceSec =
+              CAST(SUBSTR(timeOnIce, 1, INSTR(timeOnIce, ':') - 1) AS INTEGER) * 60
+              + CAST(SUBSTR(timeOnIce, INSTR(timeOnIce, ':') + 1) AS INTEGER),
+            evenTimeOnIceSec =
+              CAST(SUBSTR(evenTimeOnIce, 1, INSTR(evenTimeOnIce, ':') - 1) AS INTEGER) * 60
+              + CAST(SUBSTR(evenTimeOnIce, INSTR(evenTimeOnIce, ':') + 1) AS INTEGER),
+            powerPlayTimeOnIceSec =
+              CAST(SUBSTR(powerPlayTimeOnIce, 1, INSTR(powerPlayTimeOnIce, ':') - 1) AS INTEGER) * 60
+              + CAST(SUBSTR(powerPlayTimeOnIce, INSTR(powerPlayTimeOnIce, ':') + 1) AS INTEGER),
+            shortHandedTimeOnIceSec =
+              CAST(SUBSTR(shortHandedTimeOnIce, 1, INSTR(shortHandedTimeOnIce, ':') - 1) AS INTEGER) * 60
+              + CAST(SUBSTR(shortHandedTimeOnIce, INSTR(shortHandedTimeOnIce, ':') + 1) AS INTEGER)"""),
+        ('skaterStats.timeOnIce', 'ALTER TABLE skaterStats DROP COLUMN timeOnIce'),
+        ('skaterStats.evenTimeOnIce', 'ALTER TABLE skaterStats DROP COLUMN evenTimeOnIce'),
+        ('skaterStats.powerPlayTimeOnIce', 'ALTER TABLE skaterStats DROP COLUMN powerPlayTimeOnIce'),
+        ('skaterStats.shortHandedTimeOnIce', 'ALTER TABLE skaterStats DROP COLUMN shortHandedTimeOnIce')
+    ]),
+    # Leaderboards of the Final games (refreshed by update_seasons): players of a season ordered
+    # by a statistic, so top N is a range read of the primary key. Filled from the stored games.
+    (8, [
+        """
+        CREATE TABLE IF NOT EXISTS season_leaders (
+          season INT UNSIGNED NOT NULL,
+          stat VARCHAR(30) NOT NULL,
+          place SMALLINT UNSIGNED NOT NULL,
+          personId INT UNSIGNED NOT NULL,
+          value INT NOT NULL,
+          PRIMARY KEY(season, stat, place)
+        )"""
+    ] + [
+        f"""
+        INSERT INTO season_leaders (season, stat, place, personId, value)
+        SELECT g.season, '{stat}',
+               ROW_NUMBER() OVER (PARTITION BY g.season ORDER BY SUM({expression}) DESC, s.personId),
+               s.personId, SUM({expression})
+        FROM {table} s INNER JOIN games g ON s.gamePk = g.gamePk
+        WHERE g.gameType = 'P'
+        GROUP BY g.season, s.personId"""
+        for (stat, table, expression) in [
+            ('goals', 'skaterStats', 's.goals'),
+            ('assists', 'skaterStats', 's.assists'),
+            ('points', 'skaterStats', 's.goals + s.assists'),
+            ('plusMinus', 'skaterStats', 's.plusMinus'),
+            ('shots', 'skaterStats', 's.shots'),
+            ('hits', 'skaterStats', 's.hits'),
+            ('blocked', 'skaterStats', 's.blocked'),
+            ('penaltyMinutes', 'skaterStats', 's.penaltyMinutes'),
+            ('timeOnIceSec', 'skaterStats', 's.timeOnIceSec'),
+            ('saves', 'goalieStats', 's.saves'),
+            ('shotsAgainst', 'goalieStats', 's.shots')
+        ]
+    ]),
+    # Time of the last stored change of the data (written in the transactions of the updates),
+    # so the in-process caches of every server process can tell their entries are outdated
+    (9, [
+        """
+        CREATE TABLE IF NOT EXISTS data_version (
+          id TINYINT UNSIGNED NOT NULL PRIMARY KEY,
+          changedAt DOUBLE NOT NULL
+        )"""
+    ])
+]
+
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+# Seconds to wait while another process (replica) is migrating the schema
+SCHEMA_LOCK_TIMEOUT = int(os.environ.get('NHL_SCHEMA_LOCK_TIMEOUT', 60))
+
+# Set when the schema has been checked by this process, so later calls cost nothing
+schema_verified = False
+schema_verified_lock = threading.Lock()
+
+# Returns version of the database schema (0 for an empty database)
+def db_get_schema_version(conn):
+    cur = conn.cursor()
     try:
-        cur = conn.cursor()
-        cur.execute('SELECT version from schema_ver')
-        for (version,) in cur:
-            if version != required_version:
-                version = 0
+        cur.execute('SELECT MAX(version) FROM schema_ver')
     except mariadb.Error as err:
         if err.errno == 1146:
-            # Table not found - database is probably ampty
-            version = 0
-        else:
-            raise err
-
-    if version == 0:
-        # DB init
-        cur.execute("""
-            DROP TABLE IF EXISTS
-              schema_ver,
-              goalieStats,
-              skaterStats,
-              players,
-              games
-            """)
-        conn.commit()
+            # Table not found - database is probably empty
+            return 0
+        raise err
+
+    version = 0
+    for (max_version,) in cur:
+        version = max_version or 0
+
+    return version
+
+# True if the table ('table') or its column ('table.column') exists
+def db_object_exists(conn, name):
+    (table, _, column) = name.partition('.')
+    cur = conn.cursor()
+
+    try:
+        cur.execute(f'SELECT {column or "*"} FROM {table} LIMIT 0')
+        cur.fetchall()
+    except Exception:
+        # mariadb.Error (or sqlite3.Error of the SQLite stand-in of the benchmarks)
+        return False
+
+    return True
+
+# Execute statements of a migration step, which requirements hold
+def db_apply_statements(conn, statements):
+    cur = conn.cursor()
+
+    for statement in statements:
+        if isinstance(statement, tuple):
+            (requirements, statement) = statement
+            if not all(db_object_exists(conn, requirement.lstrip('!')) != requirement.startswith('!')
+                       for requirement in requirements.split()):
+                continue
+        cur.execute(statement)
+
+# Apply migration steps newer than the given version, returns the new version
+def db_apply_migrations(conn, version):
+    cur = conn.cursor()
 
-        cur.execute("""
-            CREATE TABLE games (
-              gamePk INT UNSIGNED NOT NULL PRIMARY KEY, 
-              season INT UNSIGNED,
-              gameType CHAR,
-              gameDate DATE,
-              team_away_id SMALLINT UNSIGNED,
-              team_away_name NVARCHAR(255),
-              team_away_score TINYINT UNSIGNED,
-              team_home_id SMALLINT UNSIGNED,
-              team_home_name NVARCHAR(255),
-              team_home_score TINYINT UNSIGNED
-            )""")
-
-        cur.execute("""
-            CREATE TABLE players (
-              gamePk INT UNSIGNED NOT NULL, 
-              personId INT UNSIGNED NOT NULL,
-              fullName NVARCHAR(255),
-              birthDate DATE,
-              birthCity NVARCHAR(50),
-              birthCountry NVARCHAR(10),
-              nationality NVARCHAR(10),
-              jerseyNumber TINYINT UNSIGNED,
-              positionName NVARCHAR(30),
-              teamName NVARCHAR(50),
-              teamId SMALLINT UNSIGNED,
-              PRIMARY KEY(gamePk, personId),
-              CONSTRAINT `fk_gamePk`
-                 FOREIGN KEY (gamePk) REFERENCES games (gamePk)
-                 ON DELETE CASCADE
-                 ON UPDATE CASCADE
-            )""")
-
-
-        cur.execute("""
-            CREATE TABLE goalieStats (
-              gamePk INT UNSIGNED NOT NULL,
-              personId INT UNSIGNED NOT NULL,
-              timeOnIce NVARCHAR(10),
-              assists SMALLINT,
-              goals SMALLINT,
-              pim SMALLINT,
-              shots SMALLINT,
-              saves SMALLINT,
-              powerPlaySaves SMALLINT,
-              shortHandedSaves SMALLINT,
-              evenSaves SMALLINT,
-              shortHandedShotsAgainst SMALLINT,
-              evenShotsAgainst SMALLINT,
-              powerPlayShotsAgainst SMALLINT,
-              savePercentage DECIMAL(17,14),
-              PRIMARY KEY(gamePk, personId),
-              CONSTRAINT `fk_game_person_g`
-                 FOREIGN KEY (gamePk, personId) REFERENCES players (gamePk, personId)
-                 ON DELETE CASCADE
-                 ON UPDATE CASCADE
-            )""")
-
-
-        cur.execute("""
-            CREATE TABLE skaterStats (
-              gamePk INT UNSIGNED NOT NULL,
-              personId INT UNSIGNED NOT NULL,
-              timeOnIce NVARCHAR(10),
-              assists SMALLINT,
-              goals SMALLINT,
-              shots SMALLINT,
-              hits SMALLINT,
-              powerPlayGoals SMALLINT,
-              powerPlayAssists SMALLINT,
-              penaltyMinutes SMALLINT,
-              faceOffWins SMALLINT,
-              faceoffTaken SMALLINT,
-              takeaways SMALLINT,
-              giveaways SMALLINT,
-              shortHandedGoals SMALLINT,
-              shortHandedAssists SMALLINT,
-              blocked SMALLINT,
-              plusMinus SMALLINT,
-              evenTimeOnIce NVARCHAR(10),
-              powerPlayTimeOnIce NVARCHAR(10),
-              shortHandedTimeOnIce NVARCHAR(10),
-              PRIMARY KEY(gamePk, personId),
-              CONSTRAINT `fk_game_person_s`
-                 FOREIGN KEY (gamePk, personId) REFERENCES players (gamePk, personId)
-                 ON DELETE CASCADE
-                 ON UPDATE CASCADE
-            )""")
-
-        cur.execute("""
-            CREATE TABLE schema_ver(
-              version SMALLINT UNSIGNED NOT NULL PRIMARY KEY
-            )""")
-        cur.execute('INSERT INTO schema_ver (version) VALUES (1)')
+    for (step_version, statements) in SCHEMA_MIGRATIONS:
+        if step_version <= version:
+            continue
+
+        db_apply_statements(conn, statements)
+        cur.execute('INSERT INTO schema_ver (version) VALUES (?)', (step_version,))
         conn.commit()
+        version = step_version
+
+    return version
 
-# Store game details to database
-def db_store_game(conn, game):
+# Upgrade the schema under a database-wide lock, so concurrent replicas don't race
+def db_migrate(conn):
     cur = conn.cursor()
-    cur.execute("""
-        REPLACE INTO games (
-           gamePk,
-           season,
-           gameType,
-           gameDate,
-           team_away_id,
-           team_away_name,
-           team_away_score,
-           team_home_id,
-           team_home_name,
-           team_home_score
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-        (
-           game['gamePk'],
-           game['season'],
-           game['gameType'],
-           game['gameDate'],
-           game['teams']['away']['team']['id'],
-           game['teams']['away']['team']['name'],
-           game['teams']['away']['score'],
-           game['teams']['home']['team']['id'],
-           game['teams']['home']['team']['name'],
-           game['teams']['home']['score']
-        )
+
+    cur.execute('SELECT GET_LOCK(?, ?)', ('nhltop_schema', SCHEMA_LOCK_TIMEOUT))
+    (locked,) = cur.fetchone()
+    if not locked:
+        raise RuntimeError('Timed out waiting for the schema migration lock')
+
+    try:
+        # Another replica could have finished the upgrade while we were waiting
+        version = db_get_schema_version(conn)
+        if version < SCHEMA_VERSION:
+            db_apply_migrations(conn, version)
+    finally:
+        cur.execute('SELECT RELEASE_LOCK(?)', ('nhltop_schema',))
+        cur.fetchone()
+
+# Update DB schema if needed (once per process). Existing data is kept, newer schemas are left as is.
+def db_update_schema(conn):
+    global schema_verified
+
+    if schema_verified:
+        return
+
+    with schema_verified_lock:
+        if schema_verified:
+            return
+
+        if db_get_schema_version(conn) < SCHEMA_VERSION:
+            db_migrate(conn)
+
+        schema_verified = True
+
+# SQL statements used to store fetched data
+GAME_REPLACE = """
+    REPLACE INTO games (
+       gamePk,
+       season,
+       gameType,
+       gameDate,
+       team_away_id,
+       team_away_name,
+       team_away_score,
+       team_home_id,
+       team_home_name,
+       team_home_score,
+       gameState
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+PERSON_INSERT = """
+    INSERT INTO persons (
+       personId,
+       fullName,
+       birthDate,
+       birthCity,
+       birthCountry,
+       nationality
+    )
+    VALUES (?, ?, ?, ?, ?, ?)"""
+
+PERSON_UPDATE = """
+    UPDATE persons
+    SET fullName = ?, birthDate = ?, birthCity = ?, birthCountry = ?, nationality = ?
+    WHERE personId = ?"""
+
+ROSTER_REPLACE = """
+    REPLACE INTO roster (
+       gamePk,
+       personId,
+       jerseyNumber,
+       positionName,
+       teamName,
+       teamId
+    )
+    VALUES (?, ?, ?, ?, ?, ?)"""
+
+GOALIE_REPLACE = """
+    REPLACE INTO goalieStats (
+       gamePk,
+       personId,
+       timeOnIceSec,
+       assists,
+       goals,
+       pim,
+       shots,
+       saves,
+       powerPlaySaves,
+       shortHandedSaves,
+       evenSaves,
+       shortHandedShotsAgainst,
+       evenShotsAgainst,
+       powerPlayShotsAgainst,
+       savePercentage
+    )
+    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"""
+
+SKATER_REPLACE = """
+    REPLACE INTO skaterStats (
+       gamePk,
+       personId,
+       timeOnIceSec,
+       assists,
+       goals,
+       shots,
+       hits,
+       powerPlayGoals,
+       powerPlayAssists,
+       penaltyMinutes,
+       faceOffWins,
+       faceoffTaken,
+       takeaways,
+       giveaways,
+       shortHandedGoals,
+       shortHandedAssists,
+       blocked,
+       plusMinus,
+       evenTimeOnIceSec,
+       powerPlayTimeOnIceSec,
+       shortHandedTimeOnIceSec
+    )
+    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"""
+
+# Number of games stored in one transaction by db_store_games_bulk (0 - all the games at once)
+DB_BATCH_GAMES = int(os.environ.get('NHL_DB_BATCH_GAMES', 0))
+
+# Game details as a row of the games table
+def game_row(game):
+    return (
+       game['gamePk'],
+       game['season'],
+       game['gameType'],
+       game['gameDate'],
+       game['teams']['away']['team']['id'],
+       game['teams']['away']['team']['name'],
+       game['teams']['away']['score'],
+       game['teams']['home']['team']['id'],
+       game['teams']['home']['team']['name'],
+       game['teams']['home']['score'],
+       game.get('status', {}).get('abstractGameState')
+    )
+
+# Player biography as a row of the persons table
+def person_row(player):
+    return (
+       player.personId,
+       player.fullName,
+       player.birthDate,
+       player.birthCity,
+       player.birthCountry,
+       player.nationality
+    )
+
+# Player details of the game as a row of the roster table
+def roster_row(player):
+    return (
+       player.gamePk,
+       player.personId,
+       player.jerseyNumber,
+       player.positionName,
+       player.teamName,
+       player.teamId
     )
 
-    conn.commit()
+# Persons are looked up in chunks of that many ids
+DB_PERSONS_CHUNK = 500
 
-# Store player statistics to the database
-def db_store_player_stat(conn, game, player):
+# Write biographies of the players, which are new or changed (persons are compared with
+# the stored ones first, so the usual re-ingest writes nothing). Returns number of rows written.
+# The caller commits.
+def db_store_persons(conn, players):
     cur = conn.cursor()
 
-    # Save personal info
-    cur.execute("""
-        REPLACE INTO players (
-           gamePk,
-           personId,
-           fullName,
-           birthDate,
-           birthCity,
-           birthCountry,
-           nationality,
-           jerseyNumber,
-           positionName,
-           teamName,
-           teamId
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-        (
-           game['gamePk'],
-           player['person']['id'],
-           player['person']['fullName'],
-           player['person']['birthDate'],
-           player['person']['birthCity'],
-           player['person']['birthCountry'],
-           player['person']['nationality'],
-           player['jerseyNumber'],
-           player['position']['name'],
-           player['team']['name'],
-           player['team']['id']
+    persons = {}
+    for player in players:
+        persons[player.personId] = person_row(player)
+
+    stored = {}
+    ids = list(persons)
+    for idx in range(0, len(ids), DB_PERSONS_CHUNK):
+        chunk = ids[idx:idx + DB_PERSONS_CHUNK]
+        cur.execute(f"""
+            SELECT personId, fullName, birthDate, birthCity, birthCountry, nationality
+            FROM persons
+            WHERE personId IN ({', '.join('?' * len(chunk))})""",
+            tuple(chunk)
         )
+        for row in cur:
+            # Dates come back as date objects, compare the text form
+            stored[row[0]] = tuple(str(value) if value is not None else None for value in row)
+
+    new_rows = []
+    changed_rows = []
+    for (personId, row) in persons.items():
+        if personId not in stored:
+            new_rows.append(row)
+        elif tuple(str(value) if value is not None else None for value in row) != stored[personId]:
+            changed_rows.append(row[1:] + row[:1])
+
+    if new_rows:
+        cur.executemany(PERSON_INSERT, new_rows)
+        record_stage('count', 'rows', len(new_rows), 'persons')
+    if changed_rows:
+        cur.executemany(PERSON_UPDATE, changed_rows)
+        record_stage('count', 'rows', len(changed_rows), 'persons')
+
+    return len(new_rows) + len(changed_rows)
+
+# Store games and statistics of their players (players_by_game maps gamePk to a list of PlayerGame).
+# Rows are written with executemany, one transaction per batch_size games; every transaction
+# updates the data version (see db_get_data_version). If the games belong
+# to one season, its top players and leaderboards are rebuilt in the transaction of the last batch,
+# so they are never behind the stored games.
+# Returns number of rows written, time spent and rows per second.
+def db_store_games_bulk(conn, games, players_by_game, batch_size=None, season=None):
+    if batch_size is None:
+        batch_size = DB_BATCH_GAMES
+    if batch_size < 1:
+        batch_size = max(len(games), 1)
+
+    cur = conn.cursor()
+    rows = 0
+    start = time.monotonic()
+
+    for idx in range(0, len(games), batch_size):
+        game_rows = []
+        players = []
+        roster_rows = []
+        goalie_rows = []
+        skater_rows = []
+
+        for game in games[idx:idx + batch_size]:
+            game_rows.append(game_row(game))
+            for player in players_by_game.get(game['gamePk'], []):
+                players.append(player)
+                roster_rows.append(roster_row(player))
+                if isinstance(player.stats, GoalieLine):
+                    goalie_rows.append(player.stats)
+                else:
+                    skater_rows.append(player.stats)
+
+        rows += db_store_persons(conn, players)
+
+        # Parent rows go first: replacing a game cascades to its roster and stats
+        for table, statement, batch in (('games', GAME_REPLACE, game_rows),
+                                        ('roster', ROSTER_REPLACE, roster_rows),
+                                        ('goalieStats', GOALIE_REPLACE, goalie_rows),
+                                        ('skaterStats', SKATER_REPLACE, skater_rows)):
+            if batch:
+                cur.executemany(statement, batch)
+                rows += len(batch)
+                record_stage('count', 'rows', len(batch), table)
+
+        cur.execute('REPLACE INTO data_version (id, changedAt) VALUES (1, ?)', (time.time(),))
+
+        if season is not None and idx + batch_size >= len(games):
+            with stage_span('db_refresh_top_players'):
+                db_refresh_top_players(conn, [season])
+            with stage_span('db_refresh_leaders'):
+                db_refresh_leaders(conn, [season])
+
+        with stage_span('db_commit'):
+            conn.commit()
+
+    elapsed = time.monotonic() - start
+
+    return {
+        'rows': rows,
+        'seconds': elapsed,
+        'rows_per_sec': rows / elapsed if elapsed > 0 else 0
+    }
+
+# Returns state and score of the season games stored in the database: {gamePk: (state, away, home)}
+def db_get_stored_games(conn, season):
+    cur = conn.cursor()
+    result = {}
+
+    cur.execute("""
+        SELECT gamePk, gameState, team_away_score, team_home_score
+        FROM games
+        WHERE season = ?""",
+        (season,)
     )
-    # Save goalie stats
-    if player['position']['name'] == 'Goalie':
-        # Check for missing keys
-        player['stats']['goalieStats']['savePercentage'] = player['stats']['goalieStats'].get('savePercentage', 0)
-        # Save data
-        cur.execute("""
-            REPLACE INTO goalieStats (
-               gamePk,
-               personId,
-               timeOnIce,
-               assists,
-               goals,
-               pim,
-               shots,
-               saves,
-               powerPlaySaves,
-               shortHandedSaves,
-               evenSaves,
-               shortHandedShotsAgainst,
-               evenShotsAgainst,
-               powerPlayShotsAgainst,
-               savePercentage
-            )
-            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-            (
-               game['gamePk'],
-               player['person']['id'],
-               player['stats']['goalieStats']['timeOnIce'],
-               player['stats']['goalieStats']['assists'],
-               player['stats']['goalieStats']['goals'],
-               player['stats']['goalieStats']['pim'],
-               player['stats']['goalieStats']['shots'],
-               player['stats']['goalieStats']['saves'],
-               player['stats']['goalieStats']['powerPlaySaves'],
-               player['stats']['goalieStats']['shortHandedSaves'],
-               player['stats']['goalieStats']['evenSaves'],
-               player['stats']['goalieStats']['shortHandedShotsAgainst'],
-               player['stats']['goalieStats']['evenShotsAgainst'],
-               player['stats']['goalieStats']['powerPlayShotsAgainst'],
-               player['stats']['goalieStats']['savePercentage']
-            )
-        )
-    # Save skater stats
-    else:
-        # Check for missing keys
-        player['stats']['skaterStats']['hits'] = player['stats']['skaterStats'].get('hits', 0)
-        player['stats']['skaterStats']['takeaways'] =  player['stats']['skaterStats'].get('takeaways', 0)
-        player['stats']['skaterStats']['giveaways'] =  player['stats']['skaterStats'].get('giveaways', 0)
-        player['stats']['skaterStats']['blocked'] = player['stats']['skaterStats'].get('blocked', 0)
-
-        # Save
-        cur.execute("""
-            REPLACE INTO skaterStats (
-               gamePk,
-               personId,
-               timeOnIce,
-               assists,
-               goals,
-               shots,
-               hits,
-               powerPlayGoals,
-               powerPlayAssists,
-               penaltyMinutes,
-               faceOffWins,
-               faceoffTaken,
-               takeaways,
-               giveaways,
-               shortHandedGoals,
-               shortHandedAssists,
-               blocked,
-               plusMinus,
-               evenTimeOnIce,
-               powerPlayTimeOnIce,
-               shortHandedTimeOnIce
-            )
-            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-            (
-               game['gamePk'],
-               player['person']['id'],
-               player['stats']['skaterStats']['timeOnIce'],
-               player['stats']['skaterStats']['assists'],
-               player['stats']['skaterStats']['goals'],
-               player['stats']['skaterStats']['shots'],
-               player['stats']['skaterStats']['hits'],
-               player['stats']['skaterStats']['powerPlayGoals'],
-               player['stats']['skaterStats']['powerPlayAssists'],
-               player['stats']['skaterStats']['penaltyMinutes'],
-               player['stats']['skaterStats']['faceOffWins'],
-               player['stats']['skaterStats']['faceoffTaken'],
-               player['stats']['skaterStats']['takeaways'],
-               player['stats']['skaterStats']['giveaways'],
-               player['stats']['skaterStats']['shortHandedGoals'],
-               player['stats']['skaterStats']['shortHandedAssists'],
-               player['stats']['skaterStats']['blocked'],
-               player['stats']['skaterStats']['plusMinus'],
-               player['stats']['skaterStats']['evenTimeOnIce'],
-               player['stats']['skaterStats']['powerPlayTimeOnIce'],
-               player['stats']['skaterStats']['shortHandedTimeOnIce']
-            )
-        )
 
-    conn.commit()
+    for (gamePk, gameState, team_away_score, team_home_score) in cur:
+        result[gamePk] = (gameState, team_away_score, team_home_score)
+
+    return result
+
+# True if the schedule game is already stored as finished and its score hasn't changed since
+def is_game_stored(game, stored_games):
+    stored = stored_games.get(game['gamePk'])
+    if stored is None or stored[0] != 'Final':
+        return False
+
+    return stored == (
+        game.get('status', {}).get('abstractGameState'),
+        game['teams']['away']['score'],
+        game['teams']['home']['score']
+    )
+
+# Fetch All-stars and Final games of the seasons from the API and store them to the database.
+# Finished games, which are already stored, are skipped unless force is set; games, which
+# boxscores could not be fetched, are counted as failed and left for the next update.
+# Every season is written in its own transaction; returns totals of db_store_games_bulk
+# and the list of stored gamePks. progress(games, rows) is called after each season is stored.
+# Top players and leaderboards of a season are refreshed in the transaction of its games.
+def update_seasons(conn, seasons, workers=None, force=False, progress=None):
+    result = {'games': 0, 'skipped': 0, 'failed': 0, 'rows': 0, 'seconds': 0, 'gamePks': []}
+
+    for season in seasons:
+        with stage_span('get_season_games'):
+            games = get_season_games(season, 'A')
+            games += iter_season_games(season, 'P', final_only=True)
+
+        if not force:
+            with stage_span('db_get_stored_games'):
+                stored_games = db_get_stored_games(conn, season)
+            new_games = [game for game in games if not is_game_stored(game, stored_games)]
+            result['skipped'] += len(games) - len(new_games)
+            games = new_games
+
+        with stage_span('get_game_players'):
+            games_players = get_games_players(games, workers)
+
+        # Games without players (boxscore not fetched) are not stored, so the next update retries them
+        players_by_game = {}
+        for game, players in zip(games, games_players):
+            if players:
+                players_by_game[game['gamePk']] = players
+            else:
+                print(f"Game {game['gamePk']}: no players in the boxscore, not stored")
+        result['failed'] += len(games) - len(players_by_game)
+        games = [game for game in games if game['gamePk'] in players_by_game]
+
+        with stage_span('db_store_games'):
+            stored = db_store_games_bulk(conn, games, players_by_game, season=season)
+        result['games'] += len(games)
+        result['gamePks'] += [game['gamePk'] for game in games]
+        result['rows'] += stored['rows']
+        result['seconds'] += stored['seconds']
+
+        if progress is not None:
+            progress(len(games), stored['rows'])
+
+    result['rows_per_sec'] = result['rows'] / result['seconds'] if result['seconds'] > 0 else 0
+
+    return result
+
+# Time of the last stored update of the games (0 if there were none); it changes with every update
+# transaction (web jobs and the CLI alike), so it serves as the version of the cached data
+def db_get_data_version(conn):
+    cur = conn.cursor()
+
+    cur.execute('SELECT changedAt FROM data_version WHERE id = 1')
+    row = cur.fetchone()
+
+    return row[0] if row else 0
+
+# Seasons stored in the database
+SEASONS_QUERY = 'SELECT DISTINCT season FROM games'
 
 # Returns a list of seasons stored in the database
 def db_get_seasons(conn):
     cur = conn.cursor()
     result = []
 
-    cur.execute('SELECT DISTINCT season FROM games') 
+    cur.execute(SEASONS_QUERY)
 
     for (season,) in cur:
         result.append(season)
 
     return result
 
+# Players, who played both All-stars and Final games, with their last Final game of the season
+# ({season_filter} is empty for all seasons or limits the query to one season)
+TOP_PLAYERS_QUERY = """
+    WITH finals AS
+     (SELECT r.personId,
+             r.gamePk,
+             g.season,
+             ROW_NUMBER() OVER (PARTITION BY g.season, r.personId ORDER BY r.gamePk DESC) AS rn
+      FROM roster r INNER JOIN games g ON r.gamePk = g.gamePk
+      WHERE g.gameType = 'P' {season_filter}),
+    all_stars AS
+     (SELECT DISTINCT
+             r.personId,
+             g.season
+      FROM roster r INNER JOIN games g ON r.gamePk = g.gamePk
+      WHERE g.gameType = 'A' {season_filter})
+    SELECT f.season,
+           f.personId,
+           p.fullName,
+           f.gamePk
+    FROM finals f
+         INNER JOIN all_stars a ON f.personId = a.personId AND f.season = a.season
+         INNER JOIN persons p ON f.personId = p.personId
+    WHERE f.rn = 1
+    ORDER BY f.season, p.fullName"""
+
+# Materialized TOP_PLAYERS_QUERY results (season_top_players table)
+TOP_PLAYERS_INSERT = """
+    INSERT INTO season_top_players (season, personId, fullName, gamePk)
+    VALUES (?,?,?,?)"""
+
+TOP_PLAYERS_SELECT = """
+    SELECT season, personId, fullName, gamePk
+    FROM season_top_players
+    {season_filter}
+    ORDER BY season, fullName"""
+
+# Recompute top players of the seasons and replace their materialized rows. The caller commits.
+def db_refresh_top_players(conn, seasons):
+    cur = conn.cursor()
+
+    for season in seasons:
+        cur.execute(TOP_PLAYERS_QUERY.format(season_filter='AND g.season = ?'), (season, season))
+        rows = cur.fetchall()
+
+        cur.execute('DELETE FROM season_top_players WHERE season = ?', (season,))
+        if rows:
+            cur.executemany(TOP_PLAYERS_INSERT, rows)
+
 # Retrieve players, who played both All-stars and Final games of the season
 def db_get_top_players(conn, season):
     cur = conn.cursor()
     result = {'players': []}
 
-    cur.execute("""
-        WITH q1 AS
-         (SELECT p.personId,
-                 p.gamePk,
-                 g.gameType,
-                 g.season 
-          FROM players p INNER JOIN games g ON p.gamePk = g.gamePk WHERE g.gameType = 'P'),
-        q2 AS
-         (SELECT p.personId,
-                 p.gamePk, 
-                 g.gameType,
-                 g.season 
-         FROM players p INNER JOIN games g ON p.gamePk = g.gamePk WHERE g.gameType = 'A')
-        SELECT DISTINCT
-          q1.personId,
-          q1.season
-        FROM q1 INNER JOIN q2 ON q1.personId = q2.personId AND q1.season = q2.season
-        WHERE q1.season = ?
-        """,
-        (season,)
-    )
+    cur.execute(TOP_PLAYERS_SELECT.format(season_filter='WHERE season = ?'), (season,))
 
-    players = []
-    for (personId, season) in cur:
-        players.append(personId)
+    for (season, personId, fullName, gamePk) in cur:
+        result['players'].append({'personId': personId, 'fullName': fullName, 'gamePk': gamePk})
 
-    for player in players:
-        cur.execute("""
-            SELECT p.personId, p.gamePk, p.fullName, g.gameType, g.season 
-            FROM players p INNER JOIN games g ON p.gamePk = g.gamePk
-            WHERE g.gameType = 'P' AND p.personId = ? AND g.season = ?
-            ORDER BY g.gamePk DESC LIMIT 1""",
-            (player, season)
-        )
-        for (personId, gamePk, fullName, gameType, season) in cur:
-            result['players'].append({'personId': personId, 'fullName': fullName, 'gamePk': gamePk})
+    return result
+
+# Same as db_get_top_players, but for all the seasons at once: {season: {'players': [...]}}.
+# Seasons without such players are omitted.
+def db_get_all_top_players(conn):
+    cur = conn.cursor()
+    result = {}
+
+    cur.execute(TOP_PLAYERS_SELECT.format(season_filter=''))
+
+    for (season, personId, fullName, gamePk) in cur:
+        result.setdefault(season, {'players': []})
+        result[season]['players'].append({'personId': personId, 'fullName': fullName, 'gamePk': gamePk})
+
+    return result
+
+# Leaderboard statistics: stat -> (table, per-game expression summed over the Final games of a season)
+LEADER_STATS = {
+    'goals': ('skaterStats', 's.goals'),
+    'assists': ('skaterStats', 's.assists'),
+    'points': ('skaterStats', 's.goals + s.assists'),
+    'plusMinus': ('skaterStats', 's.plusMinus'),
+    'shots': ('skaterStats', 's.shots'),
+    'hits': ('skaterStats', 's.hits'),
+    'blocked': ('skaterStats', 's.blocked'),
+    'penaltyMinutes': ('skaterStats', 's.penaltyMinutes'),
+    'timeOnIceSec': ('skaterStats', 's.timeOnIceSec'),
+    'saves': ('goalieStats', 's.saves'),
+    'shotsAgainst': ('goalieStats', 's.shots')
+}
+
+# Ordered totals of a statistic per player of a season ({table} and {expression} from LEADER_STATS)
+LEADERS_INSERT = """
+    INSERT INTO season_leaders (season, stat, place, personId, value)
+    SELECT g.season, ?,
+           ROW_NUMBER() OVER (ORDER BY SUM({expression}) DESC, s.personId),
+           s.personId, SUM({expression})
+    FROM {table} s INNER JOIN games g ON s.gamePk = g.gamePk
+    WHERE g.gameType = 'P' AND g.season = ?
+    GROUP BY g.season, s.personId"""
+
+LEADERS_SELECT = """
+    SELECT l.place, l.personId, p.fullName, l.value
+    FROM season_leaders l INNER JOIN persons p ON l.personId = p.personId
+    WHERE l.season = ? AND l.stat = ? AND l.place <= ?
+    ORDER BY l.place"""
+
+# Rebuild the leaderboards of the seasons. The caller commits.
+def db_refresh_leaders(conn, seasons):
+    cur = conn.cursor()
+
+    for season in seasons:
+        cur.execute('DELETE FROM season_leaders WHERE season = ?', (season,))
+        for (stat, (table, expression)) in LEADER_STATS.items():
+            cur.execute(LEADERS_INSERT.format(table=table, expression=expression), (stat, season))
+
+# Retrieve top count players of the season by the statistic (LEADER_STATS key).
+# Players with equal values share the rank (1, 2, 2, 4).
+def db_get_leaders(conn, season, stat, count):
+    cur = conn.cursor()
+    result = {'season': season, 'stat': stat, 'leaders': []}
+
+    cur.execute(LEADERS_SELECT, (season, stat, count))
+
+    rank = 0
+    last_value = None
+    for (place, personId, fullName, value) in cur:
+        if value != last_value:
+            (rank, last_value) = (place, value)
+        result['leaders'].append({'rank': rank, 'personId': personId, 'fullName': fullName, 'value': value})
 
     return result
 
@@ -473,10 +1425,13 @@ def db_get_game(conn, gamePk):
     cur = conn.cursor()
     result = {}
 
-    cur.execute("SELECT * FROM games WHERE gamePk = ?", (gamePk,))
-    for (gamePk, season, gameType, gameDate, 
-         team_away_id, team_away_name, team_away_score,
-         team_home_id, team_home_name, team_home_score) in cur:
+    cur.execute("""
+        SELECT gameDate, team_away_name, team_away_score, team_home_name, team_home_score
+        FROM games
+        WHERE gamePk = ?""",
+        (gamePk,)
+    )
+    for (gameDate, team_away_name, team_away_score, team_home_name, team_home_score) in cur:
 
         result['gameDate'] = gameDate
         result['team_away_name'] = team_away_name
@@ -492,10 +1447,10 @@ def db_get_player_stat(conn, personId, gamePk):
     result = {}
 
     cur.execute("""
-            SELECT fullName, birthDate, birthCity, birthCountry,
-                   nationality, jerseyNumber, positionName, teamName
-            FROM players
-            WHERE personId = ? AND gamePk = ?""",
+            SELECT p.fullName, p.birthDate, p.birthCity, p.birthCountry,
+                   p.nationality, r.jerseyNumber, r.positionName, r.teamName
+            FROM roster r INNER JOIN persons p ON r.personId = p.personId
+            WHERE r.personId = ? AND r.gamePk = ?""",
             (personId, gamePk)
     )
 
@@ -513,15 +1468,20 @@ def db_get_player_stat(conn, personId, gamePk):
 
         if positionName == 'Goalie':
             # Get goalie stat
-            cur.execute("""SELECT * FROM goalieStats 
-                           WHERE personId = ? AND gamePk = ?""",
-                        (personId, gamePk))
+            cur.execute("""
+                SELECT timeOnIceSec, assists, goals, pim, shots, saves,
+                       powerPlaySaves, shortHandedSaves, evenSaves,
+                       shortHandedShotsAgainst, evenShotsAgainst,
+                       powerPlayShotsAgainst, savePercentage
+                FROM goalieStats
+                WHERE personId = ? AND gamePk = ?""",
+                (personId, gamePk))
             result['goalieStats'] = {}
-            for (gamePk, personId, timeOnIce, assists, goals, pim, shots, saves,
-                  powerPlaySaves, shortHandedSaves, evenSaves,
-                  shortHandedShotsAgainst, evenShotsAgainst,
-                  powerPlayShotsAgainst, savePercentage ) in cur:
-                result['goalieStats']['timeOnIce'] = timeOnIce
+            for (timeOnIceSec, assists, goals, pim, shots, saves,
+                 powerPlaySaves, shortHandedSaves, evenSaves,
+                 shortHandedShotsAgainst, evenShotsAgainst,
+                 powerPlayShotsAgainst, savePercentage) in cur:
+                result['goalieStats']['timeOnIceSec'] = timeOnIceSec
                 result['goalieStats']['assists'] = assists
                 result['goalieStats']['goals'] = goals
                 result['goalieStats']['pim'] = pim
@@ -536,16 +1496,22 @@ def db_get_player_stat(conn, personId, gamePk):
                 result['goalieStats']['savePercentage'] = savePercentage
         else:
             # Get skater stat
-            cur.execute("""SELECT * FROM skaterStats 
-                           WHERE personId = ? AND gamePk = ?""",
-                        (personId, gamePk))
+            cur.execute("""
+                SELECT timeOnIceSec, assists, goals, shots, hits,
+                       powerPlayGoals, powerPlayAssists, penaltyMinutes, faceOffWins,
+                       faceoffTaken, takeaways, giveaways, shortHandedGoals,
+                       shortHandedAssists, blocked, plusMinus, evenTimeOnIceSec,
+                       powerPlayTimeOnIceSec, shortHandedTimeOnIceSec
+                FROM skaterStats
+                WHERE personId = ? AND gamePk = ?""",
+                (personId, gamePk))
             result['skaterStats'] = {}
-            for (gamePk, personId, timeOnIce, assists, goals, shots, hits,
+            for (timeOnIceSec, assists, goals, shots, hits,
                  powerPlayGoals, powerPlayAssists, penaltyMinutes, faceOffWins,
                  faceoffTaken, takeaways, giveaways, shortHandedGoals,
-                 shortHandedAssists, blocked, plusMinus, evenTimeOnIce,
-                 powerPlayTimeOnIce, shortHandedTimeOnIce) in cur:
-                result['skaterStats']['timeOnIce'] = timeOnIce
+                 shortHandedAssists, blocked, plusMinus, evenTimeOnIceSec,
+                 powerPlayTimeOnIceSec, shortHandedTimeOnIceSec) in cur:
+                result['skaterStats']['timeOnIceSec'] = timeOnIceSec
                 result['skaterStats']['assists'] = assists
                 result['skaterStats']['goals'] = goals
                 result['skaterStats']['shots'] = shots
@@ -561,9 +1527,9 @@ def db_get_player_stat(conn, personId, gamePk):
                 result['skaterStats']['shortHandedAssists'] = shortHandedAssists
                 result['skaterStats']['blocked'] = blocked
                 result['skaterStats']['plusMinus'] = plusMinus
-                result['skaterStats']['evenTimeOnIce'] = evenTimeOnIce
-                result['skaterStats']['powerPlayTimeOnIce'] = powerPlayTimeOnIce
-                result['skaterStats']['shortHandedTimeOnIce'] = shortHandedTimeOnIce
+                result['skaterStats']['evenTimeOnIceSec'] = evenTimeOnIceSec
+                result['skaterStats']['powerPlayTimeOnIceSec'] = powerPlayTimeOnIceSec
+                result['skaterStats']['shortHandedTimeOnIceSec'] = shortHandedTimeOnIceSec
 
     return result
 
@@ -585,33 +1551,59 @@ if __name__ == "__main__":
     db_update_schema(db_conn)
 
     if arg == 'update':
-        seasons = get_last_seasons(3)
+        # 'update force' re-fetches the games, which are already stored
+        force = 'force' in sys.argv[2:]
 
-        for season in seasons:
-            all_stars_games = get_season_games(season, 'A')
-            playoff_games = get_season_games(season, 'P')
-
-            final_games = []
-            for game in playoff_games:
-                if str(game['gamePk'])[7] == '4':
-                    final_games.append(game)
+        # Wait for the update jobs of the web app (see jobs.UPDATE_LOCK), they write the same rows
+        cur = db_conn.cursor()
+        cur.execute('SELECT GET_LOCK(?, ?)', ('nhltop_update', -1))
+        cur.fetchone()
 
-            for game in all_stars_games + final_games:
-                players = get_game_players(game['gamePk'])
-                db_store_game(db_conn, game)
-                for p in players:
-                    db_store_player_stat(db_conn, game, p)
+        seasons = get_last_seasons(3)
+        stored = update_seasons(db_conn, seasons, force=force)
+        print(f"DB: {stored['games']} games ({stored['skipped']} already stored, {stored['failed']} failed), "
+              f"{stored['rows']} rows written in "
+              f"{stored['seconds']:.2f} s ({stored['rows_per_sec']:.0f} rows/sec)")
+
+        stats = get_http_stats()
+        print(f"HTTP: {stats['requests']} requests, {stats['connections']} connections opened, "
+              f"{stats['reused']} reused")
+
+        print('Stages:')
+        for line in format_stage_stats():
+            print(f'  {line}')
+
+    elif arg == 'analytics':
+        # 'analytics [season]' prints the season (or all seasons) rollup of the Final games
+        from contextlib import nullcontext
+        import analytics
+
+        season = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        rollup = analytics.get_rollup(lambda: nullcontext(db_conn), season)
+
+        print(f"Rollup of {season or 'all seasons'} computed in {rollup['seconds'] * 1000:.1f} ms")
+        print('Skaters by points:')
+        for player in rollup['skaters'][:10]:
+            print(f"  {player['pointsRank']:>3}. {player['fullName']:<30} {player['games']:>3} GP "
+                  f"{player['goals']:>3} G {player['assists']:>3} A {player['points']:>3} P "
+                  f"{player['pointsPerGame']:.2f} P/GP")
+        print('Goalies by save percentage:')
+        for player in rollup['goalies'][:5]:
+            print(f"  {player['savePctRank']:>3}. {player['fullName']:<30} {player['games']:>3} GP "
+                  f"{player['saves']:>4}/{player['shots']:<4} {player['savePct']:.2f}% "
+                  f"{player['goalsAgainstAverage']:.2f} GAA")
 
     else:
         seasons = db_get_seasons(db_conn)
 
+        top_players = db_get_all_top_players(db_conn)
+
         print('Players, who took part both in All-stars and Final games:')
 
         for season in seasons:
             print(f'Season: {season}')
 
-            top_players = db_get_top_players(db_conn, season)
-            for player in top_players['players']:
+            for player in top_players.get(season, {'players': []})['players']:
                 print(db_get_player_stat(db_conn, player['personId'], player['gamePk']))
                 print(db_get_game(db_conn, player['gamePk']), '\n')
 
@@ -1,5 +1,23 @@
 #!/usr/bin/env python
 
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import contextlib
+import gzip
+import threading
+import json
+import time
+import os
+import pytest
+import mariadb
+import httpcache
+import sqlite3
+import analytics
+import cache
+import benchmark
+import dbpool
+import dbstats
+import fakeapi
+import jobs
 import nhltop
 
 def test_get_with_retries():
@@ -18,3 +36,725 @@ def test_get_season_games():
 
 def test_get_game_players():
     assert len(nhltop.get_game_players(2018040643)) == 22
+
+def test_http_connection_reuse(fake_api):
+    before = nhltop.get_http_stats()
+    nhltop.get_with_retries(fake_api.url + 'seasons/current')
+    nhltop.get_with_retries(fake_api.url + 'seasons/current')
+    after = nhltop.get_http_stats()
+    assert after['requests'] - before['requests'] >= 2
+    assert after['connections'] - before['connections'] <= 1
+
+def test_is_game_stored():
+    game = {
+        'gamePk': 2018030411,
+        'status': {'abstractGameState': 'Final'},
+        'teams': {'away': {'score': 2}, 'home': {'score': 3}}
+    }
+    assert nhltop.is_game_stored(game, {2018030411: ('Final', 2, 3)})
+    assert not nhltop.is_game_stored(game, {2018030411: ('Final', 2, 2)})
+    assert not nhltop.is_game_stored(game, {2018030411: ('Live', 2, 3)})
+    assert not nhltop.is_game_stored(game, {})
+
+# Boxscore entry of a goalie, which id is the same as the game id
+def stub_player(person_id):
+    stats = {
+        'timeOnIce': '60:00', 'assists': 0, 'goals': 0, 'pim': 0, 'shots': 30, 'saves': 28,
+        'powerPlaySaves': 3, 'shortHandedSaves': 0, 'evenSaves': 25, 'shortHandedShotsAgainst': 0,
+        'evenShotsAgainst': 27, 'powerPlayShotsAgainst': 3, 'savePercentage': 93.33
+    }
+    person = {
+        'id': person_id, 'fullName': 'Stub Player', 'birthDate': '1990-01-01',
+        'birthCity': 'Montreal', 'birthCountry': 'CAN', 'nationality': 'CAN'
+    }
+    return {'person': person, 'jerseyNumber': '1', 'position': {'name': 'Goalie'},
+            'stats': {'goalieStats': stats}}
+
+# Local stub of the NHL API boxscore endpoint (slow replies, first request of each game gets 429)
+class StubNHLHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    delay = 0.2
+    throttled = set()
+    requests = 0
+
+    def do_GET(self):
+        StubNHLHandler.requests += 1
+        game_id = int(self.path.split('/')[-2])
+
+        if game_id not in self.throttled:
+            self.throttled.add(game_id)
+            self.reply(429, {})
+            return
+
+        time.sleep(self.delay)
+        team = {'team': {'id': 1, 'name': 'Stub'}, 'players': {'ID1': stub_player(game_id)}}
+        self.reply(200, {'teams': {'away': team, 'home': team}})
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def stub_api(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubNHLHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(nhltop, 'API_URL', f'http://127.0.0.1:{server.server_port}/')
+    StubNHLHandler.throttled.clear()
+    yield server
+    server.shutdown()
+
+# Schedule server, which sends the first half of the reply and closes the connection
+class TruncatedScheduleHandler(BaseHTTPRequestHandler):
+    body = json.dumps({'dates': [{'date': '2019-06-0%d' % day, 'games': []} for day in range(1, 10)]}).encode()
+    content_length = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if self.content_length:
+            self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body[:len(self.body) // 2])
+        self.wfile.flush()
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+@pytest.mark.parametrize('content_length', [True, False])
+def test_stream_truncated_reply(monkeypatch, tmp_path, content_length):
+    monkeypatch.setattr(TruncatedScheduleHandler, 'content_length', content_length)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TruncatedScheduleHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/schedule'
+    try:
+        # No items from a cut reply, and nothing is cached
+        cache = httpcache.HTTPCache(str(tmp_path))
+        monkeypatch.setattr(nhltop, 'http_cache', cache)
+        assert list(nhltop.stream_with_retries(url, 'dates.item', ttl=60)) == []
+        assert cache.load(url) is None
+
+        # An expired cache entry is used instead
+        cache.store(url, b'{"dates": [{"date": "2019-06-01", "games": []}]}', ttl=1)
+        monkeypatch.setattr(cache, 'is_fresh', lambda entry: False)
+        assert list(nhltop.stream_with_retries(url, 'dates.item', ttl=60)) == [{'date': '2019-06-01', 'games': []}]
+    finally:
+        server.shutdown()
+
+def test_get_games_players_parallel(stub_api):
+    games = [{'gamePk': 2018040640 + i} for i in range(8)]
+
+    start = time.monotonic()
+    sequential = nhltop.get_games_players(games, workers=1)
+    sequential_time = time.monotonic() - start
+
+    StubNHLHandler.throttled.clear()
+    start = time.monotonic()
+    parallel = nhltop.get_games_players(games, workers=8)
+    parallel_time = time.monotonic() - start
+
+    assert parallel == sequential
+    assert [players[0].personId for players in parallel] == [g['gamePk'] for g in games]
+    assert parallel_time * 3 < sequential_time
+
+@pytest.fixture
+def db_conn():
+    try:
+        conn = nhltop.db_connect()
+    except mariadb.Error as err:
+        pytest.skip(f'Database is not available: {err.msg}')
+    nhltop.db_update_schema(conn)
+    yield conn
+    conn.close()
+
+# Table scans of the base tables (derived tables of the CTEs are not checked)
+def full_scans(conn, query, params=()):
+    cur = conn.cursor(dictionary=True)
+    cur.execute('EXPLAIN ' + query, params)
+    return [row for row in cur if row['type'] == 'ALL' and not row['table'].startswith('<')]
+
+def test_top_players_query_uses_indexes(db_conn):
+    query = nhltop.TOP_PLAYERS_QUERY.format(season_filter='AND g.season = ?')
+    assert full_scans(db_conn, query, (20182019, 20182019)) == []
+    assert full_scans(db_conn, nhltop.TOP_PLAYERS_QUERY.format(season_filter='')) == []
+
+def test_materialized_top_players_use_indexes(db_conn):
+    assert full_scans(db_conn, nhltop.TOP_PLAYERS_SELECT.format(season_filter='')) == []
+    assert full_scans(db_conn, nhltop.TOP_PLAYERS_SELECT.format(season_filter='WHERE season = ?'), (20182019,)) == []
+
+def test_leaders_select_uses_indexes(db_conn):
+    assert full_scans(db_conn, nhltop.LEADERS_SELECT, (20182019, 'goals', 10)) == []
+
+def test_seasons_query_uses_indexes(db_conn):
+    assert full_scans(db_conn, nhltop.SEASONS_QUERY) == []
+
+def test_http_cache_immutable(stub_api, monkeypatch, tmp_path):
+    monkeypatch.setattr(nhltop, 'http_cache', httpcache.HTTPCache(str(tmp_path)))
+
+    players = nhltop.get_game_players(2018040641, final=True)
+    requests = StubNHLHandler.requests
+
+    assert nhltop.get_game_players(2018040641, final=True) == players
+    assert StubNHLHandler.requests == requests
+
+def test_http_cache_entry_pairs_body(tmp_path):
+    cache = httpcache.HTTPCache(str(tmp_path))
+    url = 'http://localhost/schedule'
+
+    cache.store(url, b'{"etag": "a"}', ttl=60, etag='"a"')
+    first = cache.load(url)
+    with cache.open_body(first) as body:
+        # Replaced entry: the new validators go with the new body, the open old body is still readable
+        cache.store(url, b'{"etag": "b"}', ttl=60, etag='"b"')
+        assert json.load(body) == {'etag': 'a'}
+
+    second = cache.load(url)
+    assert second['etag'] == '"b"' and cache.read_body(second) == {'etag': 'b'}
+    # The entry loaded before the replacement reads the new body, the old one is removed
+    assert cache.read_body(first) == {'etag': 'b'}
+    assert len(os.listdir(os.path.dirname(cache.entry_path(url)))) == 2
+
+    # Revalidation keeps the body of the entry it was given
+    touched = cache.touch(second, ttl=120)
+    assert cache.load(url) == touched and touched['body'] == second['body'] and touched['ttl'] == 120
+
+def test_toi_seconds():
+    assert nhltop.toi_seconds('64:45') == 3885
+    assert nhltop.toi_seconds('0:07') == 7
+    assert nhltop.toi_seconds('') == 0
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    api = fakeapi.FakeNHLAPI(throttle=0.2).start()
+    monkeypatch.setattr(nhltop, 'API_URL', api.url)
+    monkeypatch.setattr(nhltop, 'http_cache', None)
+    yield api
+    api.stop()
+
+def test_update_from_fake_api(fake_api, tmp_path):
+    conn = benchmark.sqlite_connect(str(tmp_path / 'nhltop.db'))
+    seasons = nhltop.get_last_seasons(3)
+
+    first = nhltop.update_seasons(conn, seasons)
+    assert first['games'] == 24
+    # game row, roster and stats rows of both teams (scratches have no stats and are skipped),
+    # and every person once
+    (persons,) = conn.execute('SELECT COUNT(*) FROM persons').fetchone()
+    assert first['rows'] == 24 * (1 + 2 * 2 * (fakeapi.ROSTER - 1)) + persons
+    assert fake_api.throttled > 0
+
+    second = nhltop.update_seasons(conn, seasons)
+    assert second['games'] == 0
+    assert second['skipped'] == 24
+
+    top_players = nhltop.db_get_all_top_players(conn)
+    assert sorted(top_players) == [int(season) for season in seasons]
+
+    # Materialized top players match the ones computed from the games
+    cur = conn.cursor()
+    cur.execute(nhltop.TOP_PLAYERS_QUERY.format(season_filter=''))
+    computed = [{'personId': personId, 'fullName': fullName, 'gamePk': gamePk}
+                for (season, personId, fullName, gamePk) in cur]
+    assert [player for season in sorted(top_players) for player in top_players[season]['players']] == computed
+
+def test_update_retries_games_without_players(fake_api, tmp_path, monkeypatch):
+    conn = benchmark.sqlite_connect(str(tmp_path / 'nhltop.db'))
+    seasons = nhltop.get_last_seasons(1)
+    failing = nhltop.get_season_games(seasons[0], 'A')[0]['gamePk']
+
+    get_game_players = nhltop.get_game_players
+    monkeypatch.setattr(nhltop, 'get_game_players',
+                        lambda game_id, final=False: [] if game_id == failing else get_game_players(game_id, final))
+    first = nhltop.update_seasons(conn, seasons)
+    assert first['failed'] == 1
+    assert conn.execute('SELECT COUNT(*) FROM games WHERE gamePk = ?', (failing,)).fetchone() == (0,)
+
+    monkeypatch.setattr(nhltop, 'get_game_players', get_game_players)
+    second = nhltop.update_seasons(conn, seasons)
+    assert (second['games'], second['failed']) == (1, 0)
+    assert conn.execute('SELECT COUNT(*) FROM roster WHERE gamePk = ?', (failing,)).fetchone()[0] > 0
+
+def test_failed_update_keeps_stored_seasons_complete(fake_api, tmp_path, monkeypatch):
+    conn = benchmark.sqlite_connect(str(tmp_path / 'nhltop.db'))
+    seasons = nhltop.get_last_seasons(2)
+
+    get_season_games = nhltop.get_season_games
+    def failing_season_games(season, type):
+        if season == seasons[1]:
+            raise RuntimeError('API is down')
+        return get_season_games(season, type)
+
+    monkeypatch.setattr(nhltop, 'get_season_games', failing_season_games)
+    with pytest.raises(RuntimeError):
+        nhltop.update_seasons(conn, seasons)
+
+    # The season stored before the failure has its materialized rows, although the rerun skips its games
+    monkeypatch.setattr(nhltop, 'get_season_games', get_season_games)
+    nhltop.update_seasons(conn, seasons)
+    assert sorted(nhltop.db_get_all_top_players(conn)) == [int(season) for season in seasons]
+    (leader_seasons,) = conn.execute('SELECT COUNT(DISTINCT season) FROM season_leaders').fetchone()
+    assert leader_seasons == len(seasons)
+
+def test_stage_stats(fake_api, tmp_path):
+    conn = benchmark.sqlite_connect(str(tmp_path / 'nhltop.db'))
+    events = []
+    nhltop.reset_stage_stats()
+    nhltop.add_stage_observer(lambda *event: events.append(event))
+    try:
+        stored = nhltop.update_seasons(conn, nhltop.get_last_seasons(1))
+    finally:
+        nhltop.stage_observers.clear()
+
+    stats = nhltop.get_stage_stats()
+    assert stats[('span', 'api_request', 'game/{id}/boxscore')][0] == stored['games']
+    assert stats[('span', 'db_commit', '')][0] == 1
+    assert sum(total for ((kind, name, label), (count, total)) in stats.items() if name == 'rows') == stored['rows']
+    assert sum(total for ((kind, name, label), (count, total)) in stats.items() if name == 'api_retries') == fake_api.throttled
+    assert len(events) == sum(count for (count, total) in stats.values())
+
+def test_query_instrumentation(tmp_path):
+    conn = dbstats.InstrumentedConnection(benchmark.sqlite_connect(str(tmp_path / 'nhltop.db')))
+    queries = []
+    observer = lambda template, seconds, rows: queries.append((template, rows))
+    dbstats.add_query_observer(observer)
+    try:
+        nhltop.db_get_seasons(conn)
+        nhltop.db_get_game(conn, 2018030411)
+    finally:
+        dbstats.remove_query_observer(observer)
+
+    assert [template for (template, rows) in queries] == [
+        nhltop.SEASONS_QUERY,
+        dbstats.query_template('SELECT gameDate, team_away_name, team_away_score, team_home_name, '
+                               'team_home_score FROM games WHERE gamePk = ?')
+    ]
+
+def test_analytics_rollup(fake_api, tmp_path):
+    conn = benchmark.sqlite_connect(str(tmp_path / 'nhltop.db'))
+    seasons = nhltop.get_last_seasons(2)
+    nhltop.update_seasons(conn, seasons)
+    analytics.invalidate()
+
+    rollup = analytics.get_rollup(lambda: contextlib.nullcontext(conn), int(seasons[0]))
+    skaters = rollup['skaters']
+    assert [player['pointsRank'] for player in skaters] == sorted(player['pointsRank'] for player in skaters)
+    assert all(player['points'] == player['goals'] + player['assists'] for player in skaters)
+
+    # Totals match the per-game rows of the database
+    top = skaters[0]
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT COUNT(*), SUM(s.goals), SUM(s.timeOnIceSec)
+        FROM skaterStats s INNER JOIN games g ON s.gamePk = g.gamePk
+        WHERE g.gameType = 'P' AND g.season = ? AND s.personId = ?""",
+        (seasons[0], top['personId']))
+    assert cur.fetchone() == (top['games'], top['goals'], top['timeOnIceSec'])
+
+    goalies = rollup['goalies']
+    assert goalies[0]['savePct'] == round(goalies[0]['saves'] * 100 / goalies[0]['shots'], 3)
+
+    # Cached until invalidated
+    assert analytics.get_rollup(None, int(seasons[0])) is rollup
+
+def test_rank_desc():
+    assert list(analytics.rank_desc(analytics.np.array([3, 7, 3, 1]))) == [2, 1, 2, 4]
+
+def test_leaders(fake_api, tmp_path):
+    conn = benchmark.sqlite_connect(str(tmp_path / 'nhltop.db'))
+    season = int(nhltop.get_last_seasons(1)[0])
+    nhltop.update_seasons(conn, [str(season)])
+
+    cur = conn.cursor()
+    for (stat, (table, expression)) in nhltop.LEADER_STATS.items():
+        leaders = nhltop.db_get_leaders(conn, season, stat, 10)['leaders']
+        cur.execute(benchmark.LEADERS_ON_DEMAND.format(table=table, expression=expression), (season, 10))
+        assert [leader['value'] for leader in leaders] == [value for (_, _, value) in cur]
+        assert leaders[0]['rank'] == 1
+        assert all(b['rank'] == (a['rank'] if a['value'] == b['value'] else i + 2)
+                   for (i, (a, b)) in enumerate(zip(leaders, leaders[1:])))
+
+    # The migration fills the same leaderboards from the stored games
+    cur.execute('SELECT season, stat, place, personId, value FROM season_leaders ORDER BY season, stat, place')
+    refreshed = cur.fetchall()
+    cur.execute('DELETE FROM season_leaders')
+    cur.execute('DELETE FROM schema_ver WHERE version >= 8')
+    cur.execute('DROP TABLE season_leaders')
+    nhltop.db_apply_migrations(conn, 7)
+    cur.execute('SELECT season, stat, place, personId, value FROM season_leaders ORDER BY season, stat, place')
+    assert cur.fetchall() == refreshed
+
+def test_api_v1(fake_api, tmp_path, monkeypatch):
+    import app as webapp
+    import loadtest
+
+    path = str(tmp_path / 'nhltop.db')
+    conn = benchmark.sqlite_connect(path)
+    season = int(nhltop.get_last_seasons(1)[0])
+    nhltop.update_seasons(conn, [str(season)])
+    conn.close()
+
+    monkeypatch.setattr(webapp, 'db_pool', webapp.dbpool.ConnectionPool(lambda: loadtest.SQLiteConnection(path)))
+    monkeypatch.setattr(nhltop, 'schema_verified', True)
+    webapp.page_cache.invalidate()
+    webapp.stats_cache.invalidate()
+    client = webapp.app.test_client()
+
+    assert client.get('/api/v1/seasons').get_json() == {'seasons': [season]}
+
+    top = client.get(f'/api/v1/top/{season}')
+    player = top.get_json()['players'][0]
+    assert top.headers['Vary'] == 'Accept-Encoding'
+    assert client.get(f'/api/v1/top/{season}', headers={'If-None-Match': top.headers['ETag']}).status_code == 304
+
+    stats = client.get(f"/api/v1/stats?gamePk={player['gamePk']}&personId={player['personId']}",
+                       headers={'Accept-Encoding': 'gzip'})
+    assert stats.headers['Content-Encoding'] == 'gzip'
+    body = json.loads(gzip.decompress(stats.get_data()))
+    assert body['player']['fullName'] == player['fullName']
+    assert client.get(f"/api/v1/stats?gamePk={player['gamePk']}&personId=1").status_code == 404
+
+    # The encoded reply is cached, so revalidation doesn't encode it again
+    monkeypatch.setattr(webapp, 'json_dumps', None)
+    assert client.get(f"/api/v1/stats?gamePk={player['gamePk']}&personId={player['personId']}",
+                      headers={'Accept-Encoding': 'gzip', 'If-None-Match': stats.headers['ETag']}).status_code == 304
+
+def test_caches_follow_data_version(fake_api, tmp_path, monkeypatch):
+    import app as webapp
+    import loadtest
+
+    path = str(tmp_path / 'nhltop.db')
+    conn = benchmark.sqlite_connect(path)
+    season = int(nhltop.get_last_seasons(1)[0])
+    nhltop.update_seasons(conn, [str(season)])
+
+    monkeypatch.setattr(webapp, 'db_pool', webapp.dbpool.ConnectionPool(lambda: loadtest.SQLiteConnection(path)))
+    monkeypatch.setattr(webapp, 'data_version', {'value': None, 'checked': 0})
+    monkeypatch.setattr(webapp, 'DATA_VERSION_INTERVAL', 0)
+    monkeypatch.setattr(nhltop, 'schema_verified', True)
+    webapp.page_cache.invalidate()
+    client = webapp.app.test_client()
+
+    assert client.get('/api/v1/seasons').get_json() == {'seasons': [season]}
+
+    # Another process (a worker or the CLI) stores a season
+    nhltop.update_seasons(conn, [str(season - 10001)])
+
+    assert client.get('/api/v1/seasons').get_json() == {'seasons': [season - 10001, season]}
+
+# MariaDB user locks for SQLite connections (GET_LOCK/RELEASE_LOCK of the processes of one test)
+user_locks = {}
+
+def with_user_locks(conn):
+    def get_lock(name, timeout):
+        lock = user_locks.setdefault(name, threading.Lock())
+        return int(lock.acquire(timeout=timeout if timeout >= 0 else -1))
+
+    def release_lock(name):
+        user_locks[name].release()
+        return 1
+
+    conn.create_function('GET_LOCK', 2, get_lock)
+    conn.create_function('RELEASE_LOCK', 1, release_lock)
+    return conn
+
+def test_update_jobs(tmp_path, monkeypatch):
+    path = str(tmp_path / 'nhltop.db')
+    conn = with_user_locks(benchmark.sqlite_connect(path))
+    monkeypatch.setattr(jobs, 'JOB_WAIT_INTERVAL', 0.05)
+
+    def connection():
+        return contextlib.closing(with_user_locks(sqlite3.connect(path, check_same_thread=False)))
+
+    release = threading.Event()
+    seen = {}
+    def target(conn, count, force, progress):
+        release.wait(5)
+        if count == 5:
+            raise RuntimeError('API is down')
+        conn.execute("UPDATE update_jobs SET updatedAt = 0 WHERE status = 'queued'")
+        progress(3, 10)
+        seen['queued'] = conn.execute("SELECT updatedAt FROM update_jobs WHERE status = 'queued'").fetchall()
+
+    # Another process runs an update: jobs of this one wait, but stay alive
+    user_locks.setdefault(jobs.UPDATE_LOCK, threading.Lock()).acquire()
+    update_jobs = jobs.UpdateJobs(connection, target)
+    first = update_jobs.submit(conn, 3)
+    assert update_jobs.submit(conn, 3) == first
+    failing = update_jobs.submit(conn, 5)
+    assert failing != first
+
+    conn.execute('UPDATE update_jobs SET updatedAt = 0')
+    conn.commit()
+    time.sleep(0.3)
+    assert jobs.db_get_job(conn, first)['status'] == 'queued'
+    assert conn.execute('SELECT MIN(updatedAt) FROM update_jobs').fetchone()[0] > 0
+
+    user_locks[jobs.UPDATE_LOCK].release()
+    release.set()
+    update_jobs.queue.join()
+
+    job = jobs.db_get_job(conn, first)
+    assert (job['status'], job['gamesFetched'], job['rowsWritten']) == ('done', 3, 10)
+    # The job behind it was kept alive by the progress reports
+    assert len(seen['queued']) == 1 and seen['queued'][0][0] > 0
+
+    job = jobs.db_get_job(conn, failing)
+    assert (job['status'], job['error']) == ('failed', 'API is down')
+
+    # Finished jobs are not shared with new requests
+    assert update_jobs.submit(conn, 3) != first
+    update_jobs.queue.join()
+
+    # Jobs of an exiting process are marked failed
+    user_locks[jobs.UPDATE_LOCK].acquire()
+    queued = update_jobs.submit(conn, 3)
+    update_jobs.abandon('Server worker exited')
+    assert jobs.db_get_job(conn, queued)['status'] == 'failed'
+    user_locks[jobs.UPDATE_LOCK].release()
+    update_jobs.queue.join()
+
+def test_jobs_route(tmp_path, monkeypatch):
+    import app as webapp
+    import loadtest
+
+    path = str(tmp_path / 'nhltop.db')
+    conn = benchmark.sqlite_connect(path)
+    jobId = jobs.db_create_job(conn, 3, False)
+    jobs.db_update_job(conn, jobId, status='running', startedAt=time.time(), gamesFetched=8)
+
+    monkeypatch.setattr(webapp, 'db_pool', webapp.dbpool.ConnectionPool(lambda: loadtest.SQLiteConnection(path)))
+    monkeypatch.setattr(nhltop, 'schema_verified', True)
+    client = webapp.app.test_client()
+
+    job = client.get(f'/jobs/{jobId}').get_json()
+    assert (job['jobId'], job['status'], job['gamesFetched'], job['count']) == (jobId, 'running', 8, 3)
+    assert client.get('/jobs/nosuchjob').status_code == 404
+
+# Rows of an All-stars and a Final game of the 2018-2019 season in the version 1 schema
+def insert_v1_rows(conn):
+    cur = conn.cursor()
+    games = [
+        (2018040641, 20182019, 'A', '2019-01-26', 1, 'Away A', 5, 2, 'Home A', 4),
+        (2018030411, 20182019, 'P', '2019-05-27', 6, 'Boston Bruins', 2, 19, 'St. Louis Blues', 4)
+    ]
+    cur.executemany('INSERT INTO games VALUES (?,?,?,?,?,?,?,?,?,?)', games)
+
+    people = [
+        (8471000, 'Goalie One', 'Goalie'),
+        (8471001, 'Skater One', 'Center'),
+        (8471002, 'Skater Two', 'Defenseman')
+    ]
+    for (gamePk, *_) in games:
+        for (number, (personId, fullName, position)) in enumerate(people, 1):
+            if gamePk == 2018040641 and personId == 8471002:
+                continue
+            cur.execute('INSERT INTO players VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+                        (gamePk, personId, fullName, '1990-01-02', 'Montreal', 'CAN', 'CAN',
+                         number, position, 'St. Louis Blues', 19))
+            if position == 'Goalie':
+                cur.execute('INSERT INTO goalieStats VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                            (gamePk, personId, '60:00', 0, 0, 0, 30, 28, 3, 0, 25, 0, 27, 3, 93.33))
+            else:
+                cur.execute('INSERT INTO skaterStats VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                            (gamePk, personId, '18:30', number, 1, 3, 2, 0, 0, 2, 0, 0, 1, 1, 0, 0, 1, number,
+                             '15:00', '2:10', '1:20'))
+    conn.commit()
+
+# Contents of all the tables
+def dump_tables(conn):
+    tables = [name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+    return {table: sorted(conn.execute(f'SELECT * FROM {table}').fetchall(), key=repr)
+            for table in tables if table != 'schema_ver'}
+
+def test_interrupted_migrations_can_be_rerun(tmp_path):
+    steps = dict(nhltop.SCHEMA_MIGRATIONS)
+    expected = None
+
+    for version in (3, 6, 7):
+        for stop in range(len(steps[version]) + 1):
+            conn = sqlite3.connect(str(tmp_path / f'{version}-{stop}.db'))
+            nhltop.db_apply_statements(conn, steps[1])
+            conn.execute('INSERT INTO schema_ver (version) VALUES (1)')
+            insert_v1_rows(conn)
+            for step_version in range(2, version):
+                nhltop.db_apply_statements(conn, steps[step_version])
+                conn.execute('INSERT INTO schema_ver (version) VALUES (?)', (step_version,))
+
+            # The step is interrupted after the first stop statements and run again from the start
+            nhltop.db_apply_statements(conn, steps[version][:stop])
+            conn.commit()
+            nhltop.db_apply_migrations(conn, version - 1)
+
+            if expected is None:
+                expected = dump_tables(conn)
+            assert dump_tables(conn) == expected, f'migration {version} interrupted after {stop} statements'
+            conn.close()
+
+def test_upgrade_keeps_ingested_seasons(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'nhltop.db'))
+    nhltop.db_apply_statements(conn, dict(nhltop.SCHEMA_MIGRATIONS)[1])
+    conn.execute('INSERT INTO schema_ver (version) VALUES (1)')
+    insert_v1_rows(conn)
+
+    assert nhltop.db_apply_migrations(conn, 1) == nhltop.SCHEMA_VERSION
+
+    assert nhltop.db_get_seasons(conn) == [20182019]
+    assert nhltop.db_get_game(conn, 2018030411)['team_home_name'] == 'St. Louis Blues'
+
+    skater = nhltop.db_get_player_stat(conn, 8471001, 2018030411)
+    assert (skater['fullName'], skater['positionName']) == ('Skater One', 'Center')
+    assert skater['skaterStats']['timeOnIceSec'] == 18 * 60 + 30
+    assert skater['skaterStats']['powerPlayTimeOnIceSec'] == 130
+    goalie = nhltop.db_get_player_stat(conn, 8471000, 2018030411)
+    assert (goalie['goalieStats']['saves'], goalie['goalieStats']['timeOnIceSec']) == (28, 3600)
+
+    # Players of both games; the one, who played the Final only, isn't a top player
+    top_players = nhltop.db_get_top_players(conn, 20182019)['players']
+    assert [player['personId'] for player in top_players] == [8471000, 8471001]
+    assert top_players[0]['gamePk'] == 2018030411
+
+    leaders = nhltop.db_get_leaders(conn, 20182019, 'assists', 10)['leaders']
+    assert [(leader['personId'], leader['value']) for leader in leaders] == [(8471002, 3), (8471001, 2)]
+    assert nhltop.db_get_leaders(conn, 20182019, 'saves', 10)['leaders'][0]['value'] == 28
+
+# Connection of the pool tests: ping fails once it is dead
+class PoolConnection:
+    def __init__(self):
+        self.dead = False
+        self.closed = False
+
+    def ping(self):
+        if self.dead:
+            raise mariadb.Error('Server has gone away')
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+def test_pool_counts_and_timeout():
+    pool = dbpool.ConnectionPool(PoolConnection, min_size=1, max_size=2, timeout=0.1)
+
+    with pool.connection() as first:
+        assert (pool.size, pool.in_use) == (1, 1)
+        with pool.connection() as second:
+            assert second is not first
+            assert (pool.size, pool.in_use) == (2, 2)
+
+            start = time.monotonic()
+            with pytest.raises(dbpool.PoolTimeout):
+                pool.acquire()
+            assert time.monotonic() - start >= 0.1
+            assert (pool.size, pool.in_use) == (2, 2)
+
+    assert (pool.size, pool.in_use, len(pool.idle)) == (2, 0, 2)
+
+    # Idle connections are reused
+    with pool.connection() as conn:
+        assert conn in (first, second)
+
+def test_pool_replaces_dead_connections():
+    pool = dbpool.ConnectionPool(PoolConnection, min_size=1, max_size=1, timeout=0.1)
+
+    with pool.connection() as first:
+        pass
+    first.dead = True
+
+    with pool.connection() as conn:
+        assert conn is not first
+        assert first.closed
+        assert (pool.size, pool.in_use) == (1, 1)
+
+def test_pool_discards_connections_after_errors():
+    pool = dbpool.ConnectionPool(PoolConnection, min_size=1, max_size=1, timeout=0.1)
+
+    with pytest.raises(mariadb.Error):
+        with pool.connection() as broken:
+            raise mariadb.Error('Lost connection')
+
+    assert broken.closed
+    assert (pool.size, pool.in_use, pool.idle) == (0, 0, [])
+
+    # A new connection takes its place
+    with pool.connection() as conn:
+        assert conn is not broken
+        assert (pool.size, pool.in_use) == (1, 1)
+
+def test_main_page_revalidation(fake_api, tmp_path, monkeypatch):
+    import app as webapp
+    import loadtest
+
+    path = str(tmp_path / 'nhltop.db')
+    conn = benchmark.sqlite_connect(path)
+    season = int(nhltop.get_last_seasons(1)[0])
+    nhltop.update_seasons(conn, [str(season)])
+
+    monkeypatch.setattr(webapp, 'db_pool', webapp.dbpool.ConnectionPool(lambda: loadtest.SQLiteConnection(path)))
+    monkeypatch.setattr(webapp, 'data_version', {'value': None, 'checked': 0})
+    monkeypatch.setattr(nhltop, 'schema_verified', True)
+    webapp.page_cache.invalidate()
+    client = webapp.app.test_client()
+
+    page = client.get('/')
+    assert page.status_code == 200
+    assert f'Season: {str(season)[:4]}' in page.get_data(as_text=True)
+    # Validated pages may be stored, but have to be revalidated
+    assert page.headers['ETag'] and page.headers['Last-Modified']
+    assert 'no-cache' in page.headers['Cache-Control'] and 'no-store' not in page.headers['Cache-Control']
+    assert 'no-store' in client.get('/check/').headers['Cache-Control']
+
+    assert client.get('/', headers={'If-None-Match': page.headers['ETag']}).status_code == 304
+    assert client.get('/', headers={'If-Modified-Since': page.headers['Last-Modified']}).status_code == 304
+
+    # An update drops the cached page
+    webapp.run_update(conn, season - 10001, False, lambda games, rows: None)
+    updated = client.get('/', headers={'If-None-Match': page.headers['ETag']})
+    assert updated.status_code == 200
+    assert updated.headers['ETag'] != page.headers['ETag']
+    assert f'Season: {str(season - 10001)[:4]}' in updated.get_data(as_text=True)
+
+def test_lru_cache():
+    lru = cache.LRUCache(maxsize=2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    assert lru.get('a') == 1
+
+    # 'b' is the least recently used one
+    lru.put('c', 3)
+    assert len(lru) == 2
+    assert lru.get('b') is None
+    assert (lru.get('a'), lru.get('c')) == (1, 3)
+    assert (lru.hits, lru.misses) == (3, 1)
+
+    lru.invalidate(lambda key: key == 'a')
+    assert (lru.get('a'), lru.get('c')) == (None, 3)
+    lru.invalidate()
+    assert len(lru) == 0
+
+    disabled = cache.LRUCache(maxsize=0)
+    disabled.put('a', 1)
+    assert disabled.get('a') is None
+
+def test_update_drops_stats_of_reingested_games(fake_api, tmp_path, monkeypatch):
+    import app as webapp
+
+    conn = benchmark.sqlite_connect(str(tmp_path / 'nhltop.db'))
+    seasons = nhltop.get_last_seasons(2)
+    nhltop.update_seasons(conn, seasons)
+    (reingested, kept) = [nhltop.get_season_games(season, 'A')[0]['gamePk'] for season in seasons]
+
+    monkeypatch.setattr(webapp, 'stats_cache', cache.LRUCache(maxsize=10))
+    webapp.stats_cache.put((reingested, 1), 'old')
+    webapp.stats_cache.put((kept, 1), 'current')
+
+    webapp.run_update(conn, int(seasons[0]), True, lambda games, rows: None)
+    assert webapp.stats_cache.get((reingested, 1)) is None
+    assert webapp.stats_cache.get((kept, 1)) == 'current'